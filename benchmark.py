@@ -0,0 +1,351 @@
+import csv
+import json
+import random
+import subprocess
+import sys
+import time
+import timeit
+
+from braille_converter import convert_character_to_braille, convert_zhuyin_to_braille, cut_string, \
+    normalize_syllable, syllable_cache_info
+from token_count import count_tokens
+
+
+def zhuyin_corpus(n_syllables, seed=0):
+    # Long document made of the syllables and punctuation found in testdata.tsv
+    with open("testdata.tsv", encoding="utf-8") as f:
+        syllables = [row['target_zhuyin'] for row in csv.DictReader(f, delimiter='\t')]
+    punctuation = ['，', '。', '、', '？', '「', '」', '……']
+    rng = random.Random(seed)
+    parts = []
+    for i in range(n_syllables):
+        parts.append(rng.choice(syllables))
+        if rng.random() < 0.1:
+            parts.append(rng.choice(punctuation))
+    return ' '.join(parts)
+
+
+def testdata_sentences():
+    with open("testdata.tsv", encoding="utf-8") as f:
+        return [row['sentence'] for row in csv.DictReader(f, delimiter='\t')]
+
+
+def bench_import(module, repeat=3):
+    # Wall time for a fresh interpreter to import the module
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", f"import {module}"], check=True)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def bench_spacy(n_sentences=1000, batch_size=256, n_process=1):
+    from moedict_api import get_nlp, tag_chinese_sentence, tag_chinese_sentences
+
+    start = time.perf_counter()
+    get_nlp()
+    load = time.perf_counter() - start
+
+    sentences = testdata_sentences()
+    sentences = (sentences * (n_sentences // len(sentences) + 1))[:n_sentences]
+    start = time.perf_counter()
+    for sentence in sentences:
+        tag_chinese_sentence(sentence)
+    one_by_one = time.perf_counter() - start
+    start = time.perf_counter()
+    tag_chinese_sentences(sentences, batch_size=batch_size, n_process=n_process)
+    batched = time.perf_counter() - start
+    return {'model_load_s': load, 'sentences': n_sentences, 'one_by_one_per_s': n_sentences / one_by_one,
+            'pipe_per_s': n_sentences / batched, 'batch_size': batch_size, 'n_process': n_process}
+
+
+def evaluate_accuracy(compact=False, token_budget=None):
+    # Target-character accuracy on testdata.tsv with full or compact prompts (calls moedict and the LLM)
+    from cc_main import get_zhuyin
+    from corpus_pipeline import target_zhuyin
+    from prompt_generation import configure_prompts
+
+    configure_prompts(compact, token_budget)
+    rows = testdata_rows()
+    correct = 0
+    prompt_tokens = []
+    for row in rows:
+        try:
+            prompt, answer = get_zhuyin(row['sentence'])
+        except Exception:
+            prompt, answer = None, None
+        if prompt:
+            prompt_tokens.append(count_tokens(prompt))
+        predicted = target_zhuyin(row['sentence'], answer['zhuyin'], int(row['target_pos'])) if answer else ''
+        correct += normalize_syllable(predicted) == normalize_syllable(row['target_zhuyin'])
+    return {'compact': compact, 'token_budget': token_budget, 'sentences': len(rows), 'accuracy': correct / len(rows),
+            'mean_prompt_tokens': sum(prompt_tokens) / len(prompt_tokens) if prompt_tokens else 0}
+
+
+def testdata_rows():
+    with open("testdata.tsv", encoding="utf-8") as f:
+        return list(csv.DictReader(f, delimiter='\t'))
+
+
+def record_moedict(path, sentences=None):
+    # Looks up everything the pipeline needs for the sentences (on the live moedict) and saves the entries as
+    # JSON ({word: entry}) for the moedict stub
+    import moedict_api
+    from prompt_generation import PromptGenerator
+
+    moedict_api.configure_cache(":memory:")
+    for sentence in sentences if sentences is not None else testdata_sentences():
+        try:
+            PromptGenerator(sentence)
+        except Exception as e:
+            print(f"Skipping {sentence}: {e}", file=sys.stderr)
+    entries = dict(moedict_api.get_cache().items())
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(entries, f, ensure_ascii=False)
+    return len(entries)
+
+
+def bench_pipeline(recording, rows=None, fast_path=True, pack_tokens=None, llm_delay=0.0):
+    # The whole pipeline over testdata.tsv against local stubs: moedict serves the recorded entries, and the
+    # LLM stub answers every prompt with the readings it lists (the first dictionary reading for unknown words),
+    # so accuracy is that of the dictionary baseline unless the LLM cache holds real answers. Caches start empty.
+    import openai
+    import cc_main
+    import moedict_api
+    from corpus_pipeline import target_zhuyin
+    from stub_servers import start_completion_stub, start_moedict_stub
+
+    rows = rows if rows is not None else testdata_rows()
+    with open(recording, encoding="utf-8") as f:
+        moedict_server, moedict_url = start_moedict_stub(json.load(f))
+    completion_server, completion_url = start_completion_stub(delay=llm_delay)
+    moedict_api.use_index(None)
+    moedict_api.configure_cache(":memory:")
+    moedict_api.configure_fetcher(moedict_url)
+    openai.api_base = completion_url
+    openai.api_key = openai.api_key or "stub"
+    cc_main.configure_llm_cache(":memory:")
+    cc_main.configure_dispatcher()
+    for counts in (cc_main.path_counts, cc_main.repair_counts, cc_main.packing_counts):
+        counts.update((key, 0) for key in counts)
+
+    stages = dict.fromkeys(['spacy', 'dictionary', 'prompt_build', 'llm', 'braille'], 0.0)
+    sentences = [row['sentence'] for row in rows]
+
+    start = time.perf_counter()
+    tagged = moedict_api.tag_chinese_sentences(sentences)
+    stages['spacy'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    entries = moedict_api.fetch_entries([token for sentence_tags in tagged for token, pos in sentence_tags
+                                         if pos != 'PUNCT' and moedict_api.needs_entry(token)])
+    analyses = []
+    for sentence, sentence_tags in zip(sentences, tagged):
+        try:
+            analyses.append(moedict_api.SentenceAnalysis(sentence, sentence_tags, entries))
+        except ValueError:
+            analyses.append(None)
+    stages['dictionary'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    zhuyins = [''] * len(rows)
+    pending = []
+    prompt_tokens = []
+    for i, (sentence, analysis) in enumerate(zip(sentences, analyses)):
+        if analysis is None:
+            continue
+        prompt_generator, answer = cc_main.route_sentence(sentence, analysis, fast_path)
+        if prompt_generator is None:
+            zhuyins[i] = answer['zhuyin']
+        else:
+            pending.append((i, prompt_generator))
+            prompt_tokens.append(prompt_generator.prompt_token_count())
+    stages['prompt_build'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    prompt_generators = [prompt_generator for _, prompt_generator in pending]
+    if pack_tokens:
+        answers = cc_main.get_packed_answers(prompt_generators, pack_tokens)
+    else:
+        answers = cc_main.get_parsed_answers(prompt_generators)
+    answered = [(i, prompt_generator, answer['zhuyin'])
+                for (i, prompt_generator), answer in zip(pending, answers) if answer is not None]
+    repaired = cc_main.repair_zhuyins([prompt_generator for _, prompt_generator, _ in answered],
+                                      [zhuyin for _, _, zhuyin in answered])
+    for (i, _, _), zhuyin in zip(answered, repaired):
+        zhuyins[i] = zhuyin
+    stages['llm'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for zhuyin in zhuyins:
+        try:
+            convert_zhuyin_to_braille(zhuyin)
+        except ValueError:
+            pass
+    stages['braille'] = time.perf_counter() - start
+
+    correct_zhuyin = correct_braille = 0
+    for row, zhuyin in zip(rows, zhuyins):
+        predicted = target_zhuyin(row['sentence'], zhuyin, int(row['target_pos'])) if zhuyin else ''
+        try:
+            braille = convert_zhuyin_to_braille(predicted)
+        except ValueError:
+            braille = ''
+        correct_zhuyin += normalize_syllable(predicted) == normalize_syllable(row['target_zhuyin'])
+        correct_braille += braille == row['target_braille']
+
+    moedict_server.shutdown()
+    completion_server.shutdown()
+    return {
+        'sentences': len(rows),
+        'fast_path': fast_path,
+        'pack_tokens': pack_tokens,
+        'stage_s': stages,
+        'total_s': sum(stages.values()),
+        'failed_sentences': analyses.count(None),
+        'moedict_requests_per_sentence': moedict_server.requests_served / len(rows),
+        'llm_requests_per_sentence': completion_server.requests_served / len(rows),
+        'llm_sentences': len(pending),
+        'mean_prompt_tokens': sum(prompt_tokens) / len(prompt_tokens) if prompt_tokens else 0,
+        'total_prompt_tokens': sum(prompt_tokens),
+        'paths': dict(cc_main.path_counts),
+        'repairs': dict(cc_main.repair_counts),
+        'target_zhuyin_accuracy': correct_zhuyin / len(rows),
+        'target_braille_accuracy': correct_braille / len(rows)
+    }
+
+
+def bench_prompt_build(recording, rows=None, repeat=3):
+    # Per-sentence cost of building prompts for prebuilt analyses (spaCy and moedict are done beforehand, against
+    # the moedict stub serving the recording), full and compact, and of packing them
+    import moedict_api
+    from prompt_generation import PackedPromptGenerator, PromptGenerator
+    from stub_servers import start_moedict_stub
+
+    rows = rows if rows is not None else testdata_rows()
+    with open(recording, encoding="utf-8") as f:
+        moedict_server, moedict_url = start_moedict_stub(json.load(f))
+    moedict_api.configure_cache(":memory:")
+    moedict_api.configure_fetcher(moedict_url)
+    sentences = [row['sentence'] for row in rows]
+    tagged = moedict_api.tag_chinese_sentences(sentences)
+    entries = moedict_api.fetch_entries([token for sentence_tags in tagged for token, pos in sentence_tags
+                                         if pos != 'PUNCT' and moedict_api.needs_entry(token)])
+    analyses = []
+    for sentence, sentence_tags in zip(sentences, tagged):
+        try:
+            analyses.append((sentence, moedict_api.SentenceAnalysis(sentence, sentence_tags, entries)))
+        except ValueError:
+            pass
+    moedict_server.shutdown()
+
+    def build(compact):
+        return [PromptGenerator(sentence, analysis, compact=compact).get_formatted_prompt()
+                for sentence, analysis in analyses]
+
+    def pack():
+        prompt_generators = [PromptGenerator(sentence, analysis) for sentence, analysis in analyses]
+        return [PackedPromptGenerator(prompt_generators[start:start + 8])
+                for start in range(0, len(prompt_generators), 8)]
+
+    n = len(analyses)
+    return {
+        'sentences': n,
+        'full_us_per_sentence': min(timeit.repeat(lambda: build(False), number=1, repeat=repeat)) / n * 1e6,
+        'compact_us_per_sentence': min(timeit.repeat(lambda: build(True), number=1, repeat=repeat)) / n * 1e6,
+        'packed_8_us_per_sentence': min(timeit.repeat(pack, number=1, repeat=repeat)) / n * 1e6
+    }
+
+
+def convert_per_symbol(zhuyin_string):
+    strings = []
+    for substring in cut_string(zhuyin_string):
+        strings.extend(substring.split())
+    return ''.join(convert_character_to_braille(string) for string in strings)
+
+
+def bench_braille(sizes=(1000, 10000, 100000), repeat=3):
+    results = []
+    for size in sizes:
+        corpus = zhuyin_corpus(size)
+        per_symbol = min(timeit.repeat(lambda: convert_per_symbol(corpus), number=1, repeat=repeat))
+        syllable_table = min(timeit.repeat(lambda: convert_zhuyin_to_braille(corpus), number=1, repeat=repeat))
+        results.append({'syllables': size, 'per_symbol_s': per_symbol, 'syllable_table_s': syllable_table})
+    return results
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for the conversion pipeline.")
+    parser.add_argument("--spacy", action="store_true", help="also time spaCy loading and tagging (needs the model)")
+    parser.add_argument("--n-process", type=int, default=1, help="worker processes for nlp.pipe")
+    parser.add_argument("--accuracy", action="store_true",
+                        help="compare full and compact prompts on testdata.tsv (needs moedict and the LLM)")
+    parser.add_argument("--token-budget", type=int, default=None, help="token budget for compact prompts")
+    parser.add_argument("--record", metavar="JSON",
+                        help="record the moedict entries testdata.tsv needs into this file (needs moedict)")
+    parser.add_argument("--pipeline", metavar="JSON",
+                        help="run the whole pipeline on testdata.tsv against local stubs serving this recording")
+    parser.add_argument("--pack-tokens", type=int, default=None, help="pack prompts in the pipeline run")
+    parser.add_argument("--llm-delay", type=float, default=0.0, help="seconds the LLM stub takes per request")
+    parser.add_argument("--imports", action="store_true",
+                        help="time importing prompt_generation and cc_main in a fresh interpreter")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="corpus sizes (syllables) for the braille micro-benchmark")
+    parser.add_argument("--json", metavar="PATH", help="also write all results to this JSON file")
+    args = parser.parse_args(argv)
+
+    if args.record:
+        print(f"recorded {record_moedict(args.record)} moedict entries to {args.record}")
+        return
+
+    results = {'braille': bench_braille(args.sizes)}
+    print("syllables\tper-symbol (s)\tsyllable table (s)\tspeedup")
+    for result in results['braille']:
+        print(f"{result['syllables']}\t{result['per_symbol_s']:.4f}\t{result['syllable_table_s']:.4f}\t"
+              f"{result['per_symbol_s'] / result['syllable_table_s']:.1f}x")
+    print(syllable_cache_info())
+
+    if args.pipeline:
+        result = results['pipeline'] = bench_pipeline(args.pipeline, pack_tokens=args.pack_tokens,
+                                                      llm_delay=args.llm_delay)
+        print(", ".join(f"{stage}: {seconds:.3f} s" for stage, seconds in result['stage_s'].items()))
+        print(f"{result['moedict_requests_per_sentence']:.2f} moedict and {result['llm_requests_per_sentence']:.2f} "
+              f"LLM requests per sentence, {result['mean_prompt_tokens']:.0f} prompt tokens on average")
+        print(f"target accuracy: zhuyin {result['target_zhuyin_accuracy']:.1%}, "
+              f"braille {result['target_braille_accuracy']:.1%}")
+
+        result = results['prompt_build'] = bench_prompt_build(args.pipeline)
+        print(f"prompt build: {result['full_us_per_sentence']:.0f} us/sentence full, "
+              f"{result['compact_us_per_sentence']:.0f} us/sentence compact, "
+              f"{result['packed_8_us_per_sentence']:.0f} us/sentence packed by 8")
+
+    if args.imports:
+        for module in ('prompt_generation', 'cc_main'):
+            results[f'import_{module}_s'] = bench_import(module)
+            print(f"import {module}: {results[f'import_{module}_s']:.3f} s")
+
+    if args.spacy:
+        results['import_moedict_api_s'] = bench_import('moedict_api')
+        print(f"import moedict_api: {results['import_moedict_api_s']:.3f} s")
+        result = results['spacy'] = bench_spacy(n_process=args.n_process)
+        print(f"model load: {result['model_load_s']:.2f} s, nlp(): {result['one_by_one_per_s']:.0f} sentences/s, "
+              f"nlp.pipe (n_process={result['n_process']}): {result['pipe_per_s']:.0f} sentences/s")
+
+    if args.accuracy:
+        results['accuracy'] = []
+        for compact in (False, True):
+            result = evaluate_accuracy(compact, args.token_budget if compact else None)
+            results['accuracy'].append(result)
+            print(f"{'compact' if compact else 'full'} prompts: accuracy {result['accuracy']:.1%}, "
+                  f"{result['mean_prompt_tokens']:.0f} prompt tokens on average")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,23 @@
+import csv
 import re
-import pandas as pd
+from functools import lru_cache
+from types import MappingProxyType
 
-df = pd.read_csv("zhuyin2braille.csv")
+import metrics
+
+
+def load_symbol_table(path):
+    # Maps every zhuyin symbol to its (type, braille) row of the CSV
+    table = {}
+    with open(path, encoding="utf-8", newline="") as f:
+        for row in csv.DictReader(f):
+            if row["zhuyin"] in table:
+                raise ValueError("Duplicate Zhuyin in symbol table: " + row["zhuyin"])
+            table[row["zhuyin"]] = (row["type"], row["braille"])
+    return MappingProxyType(table)
+
+
+symbol_table = load_symbol_table("zhuyin2braille.csv")
 
 punct = ['，',
  '、',
@@ -79,21 +95,18 @@ zhuyin = ['ㄅ',
  '˙']
 
 
-def find_single_braille_character(df, string, mode="no-check"):
-    filtered_df = df[df["zhuyin"] == string]
+def find_single_braille_character(table, string, mode="no-check"):
+    entry = table.get(string)
 
-    if not filtered_df.empty:
-        if filtered_df.shape[0] == 1:
-            if mode == "i" and filtered_df['type'].iloc[0] != "initial":
-                raise ValueError("Non-initial Zhuyin in initial position: " + string)
-            if mode == "f" and filtered_df['type'].iloc[0] != "final":
-                raise ValueError("Non-final Zhuyin in final position: " + string)
-            if mode == "t" and filtered_df['type'].iloc[0] != "tone":
-                raise ValueError("Non-tone Zhuyin in tone position: " + string)
-            braille_value = filtered_df['braille'].iloc[0]
-            return braille_value
-        else:
-            raise ImplementationError("Need to do disambiguation here")
+    if entry is not None:
+        symbol_type, braille_value = entry
+        if mode == "i" and symbol_type != "initial":
+            raise ValueError("Non-initial Zhuyin in initial position: " + string)
+        if mode == "f" and symbol_type != "final":
+            raise ValueError("Non-final Zhuyin in final position: " + string)
+        if mode == "t" and symbol_type != "tone":
+            raise ValueError("Non-tone Zhuyin in tone position: " + string)
+        return braille_value
     else:
         raise ValueError("Illegal Zhuyin: " + string)
 
@@ -110,30 +123,76 @@ def convert_character_to_braille(zhuyin_for_character):
         tone_mark = matches.group(4)
 
         if initial:
-            braille += find_single_braille_character(df, initial, mode="i")
+            braille += find_single_braille_character(symbol_table, initial, mode="i")
         if final:
-            braille += find_single_braille_character(df, final, mode="f")
+            braille += find_single_braille_character(symbol_table, final, mode="f")
         else:
             braille += "⠱"
         if tone_mark:
-            braille += find_single_braille_character(df, tone_mark, mode="t")
+            braille += find_single_braille_character(symbol_table, tone_mark, mode="t")
         if neutral_tone:
-            braille += find_single_braille_character(df, neutral_tone, mode="t")
+            braille += find_single_braille_character(symbol_table, neutral_tone, mode="t")
         if not tone_mark and not neutral_tone:
             braille += "⠄"
     else:
         i = 0
         while i < len(zhuyin_for_character):
             if zhuyin_for_character[i] in ['…', '─'] and i + 1 < len(zhuyin_for_character) and zhuyin_for_character[i+1] == zhuyin_for_character[i]:
-                braille += find_single_braille_character(df, zhuyin_for_character[i:i+2])
+                braille += find_single_braille_character(symbol_table, zhuyin_for_character[i:i+2])
                 i += 1
             else:
-                braille += find_single_braille_character(df, zhuyin_for_character[i])
+                braille += find_single_braille_character(symbol_table, zhuyin_for_character[i])
             i += 1
 
     return braille
 
 
+def build_syllable_table(table):
+    # Every initial + final + tone combination (and the leading neutral tone form), converted once
+    initials = [''] + [z for z, (symbol_type, _) in table.items() if symbol_type == "initial"]
+    finals = [''] + [z for z, (symbol_type, _) in table.items() if symbol_type == "final" and z[0] in zhuyin]
+    tones = [''] + [z for z, (symbol_type, _) in table.items() if symbol_type == "tone"]
+
+    syllables = {}
+    for initial in initials:
+        for final in finals:
+            if not initial and not final:
+                continue
+            candidates = [initial + final + tone for tone in tones] + ['˙' + initial + final]
+            for candidate in candidates:
+                try:
+                    syllables[candidate] = convert_character_to_braille(candidate)
+                except ValueError:
+                    pass
+    return MappingProxyType(syllables)
+
+
+syllable_table = None
+
+
+def get_syllable_table():
+    global syllable_table
+    if syllable_table is None:
+        syllable_table = build_syllable_table(symbol_table)
+    return syllable_table
+
+
+@lru_cache(maxsize=4096)
+def convert_uncommon_syllable(zhuyin_for_character):
+    return convert_character_to_braille(zhuyin_for_character)
+
+
+def convert_syllable_to_braille(zhuyin_for_character):
+    braille = get_syllable_table().get(zhuyin_for_character)
+    if braille is None:
+        braille = convert_uncommon_syllable(zhuyin_for_character)
+    return braille
+
+
+def syllable_cache_info():
+    return convert_uncommon_syllable.cache_info()
+
+
 def identify_character_set(char):
     if char in zhuyin or re.match(r'\s', char):
         return 1
@@ -144,34 +203,131 @@ def identify_character_set(char):
 
 def cut_string(sentence):
     parts = []
+    start = 0
     chartype = 0
+    for i, char in enumerate(sentence):
+        type_next = identify_character_set(char)
+        if i > 0 and type_next != chartype:
+            parts.append(sentence[start:i])
+            start = i
+        chartype = type_next
     if len(sentence) > 0:
-        parts.append(sentence[0])
-        chartype = identify_character_set(parts[-1][0])
-    i = 1
-    while i < len(sentence):
-        type_next = identify_character_set(sentence[i])
-        if chartype == type_next:
-            parts[-1] += sentence[i]
-        else:
-            chartype = type_next
-            parts.append(sentence[i])
-        i += 1
+        parts.append(sentence[start:])
 
     return parts
 
 
-def convert_zhuyin_to_braille(zhuyin_string, return_as_list=False):
-    converted = list()
+# One token per run of zhuyin, of single-character punctuation or of anything else, split at whitespace;
+# this is what cut_string followed by str.split produces
+single_punct = ''.join(re.escape(p) for p in punct if len(p) == 1)
+zhuyin_chars = ''.join(re.escape(z) for z in zhuyin)
+token_pattern = re.compile(rf'[{zhuyin_chars}]+|[{single_punct}]+|[^\s{zhuyin_chars}{single_punct}]+')
+
 
-    substrings = cut_string(zhuyin_string)
-    strings = []
-    for substring in substrings:
-        strings.extend(substring.split())
-    for string in strings:
-        converted.append(convert_character_to_braille(string))
+def tokenize_zhuyin(zhuyin_string):
+    return token_pattern.findall(zhuyin_string)
+
+
+def zhuyin_syllables(zhuyin_string):
+    # The syllables of a zhuyin string, without punctuation
+    return [token for token in tokenize_zhuyin(zhuyin_string) if token[0] in zhuyin]
+
+
+def normalize_syllable(syllable):
+    # One spelling per reading: the neutral tone mark after the syllable, no first tone mark
+    syllable = syllable.replace('ˉ', '')
+    if syllable.startswith('˙'):
+        syllable = syllable[1:] + '˙'
+    return syllable
+
+
+@metrics.timed("braille.convert")
+def convert_zhuyin_to_braille(zhuyin_string, return_as_list=False):
+    converted = [convert_syllable_to_braille(string) for string in tokenize_zhuyin(zhuyin_string)]
 
     if return_as_list:
         return converted
 
     return ''.join(converted).strip('')
+
+
+def iter_zhuyin_to_braille(chunks, keep_newlines=False):
+    # Yields the braille for each incoming chunk (a file object works, one line at a time); a token cut by a
+    # chunk boundary is held back until the next chunk
+    pending = ''
+    for chunk in chunks:
+        text = pending + chunk
+        pending = ''
+        converted = []
+        end = 0
+        for match in token_pattern.finditer(text):
+            if keep_newlines and '\n' in text[end:match.start()]:
+                converted.append('\n' * text.count('\n', end, match.start()))
+            if match.end() == len(text):
+                pending = match.group()
+                end = len(text)
+                break
+            converted.append(convert_syllable_to_braille(match.group()))
+            end = match.end()
+        if keep_newlines and '\n' in text[end:]:
+            converted.append('\n' * text.count('\n', end))
+        if converted:
+            yield ''.join(converted)
+    if pending:
+        yield convert_syllable_to_braille(pending)
+
+
+def convert_zhuyin_batch(zhuyin_strings, dot_masks=False):
+    # Converts a sequence (or pandas Series) of zhuyin strings at once. Every distinct string is encoded as an
+    # integer and converted once; the results are then gathered through a lookup array in one numpy pass.
+    # With dot_masks=True returns (cells, offsets): a uint8 array of dot masks (bit n-1 is dot n, as in the
+    # Unicode braille block) and the offsets of each input string's cells in it.
+    import numpy as np
+
+    vocabulary = {}
+    codes = np.fromiter((vocabulary.setdefault(zhuyin_string, len(vocabulary)) for zhuyin_string in zhuyin_strings),
+                        dtype=np.int64)
+    vocabulary_braille = [convert_zhuyin_to_braille(zhuyin_string) for zhuyin_string in vocabulary]
+
+    if not dot_masks:
+        lookup = np.empty(len(vocabulary_braille), dtype=object)
+        lookup[:] = vocabulary_braille
+        return lookup[codes].tolist()
+
+    max_cells = max((len(braille) for braille in vocabulary_braille), default=0)
+    vocabulary_lengths = np.array([len(braille) for braille in vocabulary_braille], dtype=np.int64)
+    vocabulary_masks = np.zeros((len(vocabulary_braille), max_cells), dtype=np.uint8)
+    for i, braille in enumerate(vocabulary_braille):
+        vocabulary_masks[i, :len(braille)] = [ord(cell) - 0x2800 for cell in braille]
+
+    row_lengths = vocabulary_lengths[codes]
+    offsets = np.concatenate(([0], np.cumsum(row_lengths)))
+    row_of_cell = np.repeat(np.arange(len(codes)), row_lengths)
+    cell_in_row = np.arange(offsets[-1]) - offsets[row_of_cell]
+    cells = vocabulary_masks[codes[row_of_cell], cell_in_row]
+    return cells, offsets
+
+
+def main(argv=None):
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="Convert a Zhuyin text file to Taiwanese braille, line by line.")
+    parser.add_argument("input", help="Zhuyin file, or - for stdin")
+    parser.add_argument("output", nargs="?", default="-", help="braille file, or - for stdout (default)")
+    args = parser.parse_args(argv)
+
+    infile = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")
+    outfile = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    try:
+        for chunk in iter_zhuyin_to_braille(infile, keep_newlines=True):
+            outfile.write(chunk)
+    finally:
+        if infile is not sys.stdin:
+            infile.close()
+        if outfile is not sys.stdout:
+            outfile.close()
+
+
+if __name__ == '__main__':
+    main()
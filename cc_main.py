@@ -1,27 +1,346 @@
+import hashlib
+import json
+import metrics
 import openai
 import os
-from prompt_generation import PromptGenerator
-from braille_converter import convert_zhuyin_to_braille
+from disk_cache import DiskCache
+from llm_dispatcher import CompletionDispatcher
+from moedict_api import SentenceAnalysis, fetch_entries, needs_entry, tag_chinese_sentences
+from prompt_generation import PackedPromptGenerator, PromptGenerator, SpanPromptGenerator, packed_base_tokens, \
+    packed_sentence_tokens
+from braille_converter import convert_zhuyin_to_braille, zhuyin as zhuyin_symbols, zhuyin_syllables
+from zhuyin_alignment import is_chinese, misaligned_span, span_layout, splice_zhuyin
 
-openai.api_key = os.environ['OPENAI_API_KEY']
+openai.api_key = os.environ.get('OPENAI_API_KEY')
 
+model = "gpt-4"
+completion_parameters = {"max_tokens": 1500, "temperature": 0}
 
-def get_formatted_zhuyin_and_braille(sentence):
+# Concurrent, rate-limited completions for batches; see configure_dispatcher
+dispatcher = None
+
+
+def configure_dispatcher(max_in_flight=8, requests_per_minute=500, tokens_per_minute=40000, max_retries=6):
+    global dispatcher
+    dispatcher = CompletionDispatcher(model, completion_parameters, max_in_flight=max_in_flight,
+                                      requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute,
+                                      max_retries=max_retries)
+    return dispatcher
+
+
+def get_dispatcher():
+    if dispatcher is None:
+        configure_dispatcher(int(os.environ.get("LLM_CONCURRENCY", 8)), int(os.environ.get("LLM_RPM", 500)),
+                             int(os.environ.get("LLM_TPM", 40000)))
+    return dispatcher
+
+
+# Completions are cached on disk by a hash of model, parameters and prompt; see configure_llm_cache
+llm_cache = None
+
+
+def configure_llm_cache(path="llm_cache.sqlite", max_entries=100000, ttl=None, read_only=False):
+    global llm_cache
+    if llm_cache is not None:
+        llm_cache.close()
+    llm_cache = DiskCache(path, max_entries=max_entries, ttl=ttl, read_only=read_only)
+    return llm_cache
+
+
+def get_llm_cache():
+    if llm_cache is None:
+        configure_llm_cache(os.environ.get("LLM_CACHE", "llm_cache.sqlite"))
+    return llm_cache
+
+
+def llm_cache_stats():
+    return get_llm_cache().stats()
+
+
+def prompt_key(prompt):
+    key = json.dumps({"model": model, "parameters": completion_parameters, "prompt": prompt},
+                     sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+# Number of sentences answered from the dictionary alone and by the LLM
+path_counts = {"dictionary": 0, "llm": 0}
+
+
+def path_fractions():
+    total = sum(path_counts.values())
+    return {path: count / total if total else 0.0 for path, count in path_counts.items()}
+
+
+def get_formatted_zhuyin_and_braille(sentence, analysis=None, use_cache=True, fast_path=False):
+    # With fast_path, a sentence without polyphones is answered from the dictionary and the prompt is None.
+    # LLM answers are checked against the dictionary readings and misaligned words asked again; see repair_zhuyin
     assert only_chinese(sentence)
-    prompt_generator = PromptGenerator(sentence)
-    _input = prompt_generator.get_formatted_prompt()
+    prompt, answer_parsed = get_zhuyin(sentence, analysis, use_cache, fast_path)
+    answer_parsed['braille'] = convert_zhuyin_to_braille(answer_parsed['zhuyin'])
+    return prompt, answer_parsed
+
+
+def get_zhuyin(sentence, analysis=None, use_cache=True, fast_path=False):
+    prompt_generator, answer = route_sentence(sentence, analysis, fast_path)
+    if prompt_generator is None:
+        return None, answer
+    answer_parsed = get_parsed_answer(prompt_generator, use_cache)
+    answer_parsed['zhuyin'] = repair_zhuyin(prompt_generator, answer_parsed['zhuyin'], use_cache)
+    return prompt_generator.get_formatted_prompt().text, answer_parsed
+
+
+def get_zhuyins(sentences, tagged=None, fast_path=True, pack_tokens=None, use_cache=True):
+    # get_zhuyin for many sentences: one dictionary fetch for all of them, the prompts sent concurrently (packed
+    # into shared prompts of up to pack_tokens tokens, if given) and every LLM answer repaired. Returns one
+    # (prompt text or None, answer) per sentence, or the exception that stopped that sentence.
+    if tagged is None:
+        tagged = tag_chinese_sentences(sentences)
+    entries = fetch_entries([token for sentence_tags in tagged for token, pos in sentence_tags
+                             if pos != 'PUNCT' and needs_entry(token)])
+
+    results = [None] * len(sentences)
+    pending = []
+    for i, (sentence, sentence_tags) in enumerate(zip(sentences, tagged)):
+        try:
+            if not only_chinese(sentence):
+                raise ValueError("Not only traditional Chinese characters: " + sentence)
+            analysis = SentenceAnalysis(sentence, sentence_tags, entries)
+            prompt_generator, answer = route_sentence(sentence, analysis, fast_path)
+            if prompt_generator is None:
+                results[i] = (None, answer)
+            else:
+                pending.append((i, prompt_generator))
+        except Exception as e:
+            results[i] = e
+
+    prompt_generators = [prompt_generator for _, prompt_generator in pending]
+    if pack_tokens:
+        answers = get_packed_answers(prompt_generators, pack_tokens, use_cache)
+    else:
+        answers = get_parsed_answers(prompt_generators, use_cache)
+    answered = []
+    for (i, prompt_generator), answer in zip(pending, answers):
+        if answer is None:
+            results[i] = ValueError("no usable answer from the LLM")
+        else:
+            answered.append((i, prompt_generator, answer))
+    repaired = repair_zhuyins([prompt_generator for _, prompt_generator, _ in answered],
+                              [answer['zhuyin'] for _, _, answer in answered], use_cache)
+    for (i, prompt_generator, answer), zhuyin in zip(answered, repaired):
+        answer['zhuyin'] = zhuyin
+        results[i] = (prompt_generator.get_formatted_prompt().text, answer)
+    return results
+
+
+def route_sentence(sentence, analysis=None, fast_path=False):
+    # (None, answer) when the dictionary settles the sentence, otherwise (prompt generator, None)
+    analysis = analysis if analysis is not None else SentenceAnalysis(sentence)
+    if fast_path and is_unambiguous(analysis.best_guess):
+        path_counts["dictionary"] += 1
+        return None, {'zhuyin': zhuyin_from_pronunciations(analysis.best_guess)}
+
+    path_counts["llm"] += 1
+    return PromptGenerator(sentence, analysis), None
+
+
+def is_unambiguous(preprocessed):
+    # Every token from best_guess_without_llm has a single reading (repeated readings count once), and every
+    # Chinese word's reading is plain Zhuyin: the readings of polyphones come with moedict's labels, e.g.
+    # （讀音）ㄒㄧㄥˋ, which are left to the LLM
+    return all(len(set(pron_list)) == 1 and (not any(is_chinese(char) for char in word) or is_zhuyin(pron_list[0]))
+               for word, pron_list in preprocessed)
+
+
+def is_zhuyin(reading):
+    # Zhuyin syllables separated by spaces (moedict uses full-width ones between the syllables of a word)
+    syllables = reading.split()
+    return bool(syllables) and all(char in zhuyin_symbols for syllable in syllables for char in syllable)
 
-    messages = [{"role": "user", "content": _input.to_string()}]
-    output = openai.ChatCompletion.create(
-        model="gpt-4",
-        max_tokens=1500,
-        temperature=0,
-        messages=messages)
 
-    response_string = output['choices'][0]['message']['content']
+def zhuyin_from_pronunciations(preprocessed):
+    # Same layout as the LLM answer: one syllable per character, separated by spaces (moedict separates the
+    # syllables of a word with full-width spaces)
+    return ' '.join(syllable for word, pron_list in preprocessed for syllable in pron_list[0].split())
+
+
+def get_parsed_answer(prompt_generator, use_cache=True):
+    # The cache keeps the parsed answer next to the raw response. Only answers that parse are cached, so asking
+    # again after an unparsable answer goes to the API.
+    prompt = prompt_generator.get_formatted_prompt().to_string()
+    key = prompt_key(prompt)
+    cached = get_llm_cache().get(key) if use_cache else None
+    if cached is not None and cached.get('parsed') is not None:
+        return dict(cached['parsed'])
+
+    response_string = request_completion(prompt)
     answer_parsed = prompt_generator.get_output_parser().parse(response_string)
-    answer_parsed['braille'] = convert_zhuyin_to_braille(answer_parsed['zhuyin'])
-    return _input.text, answer_parsed
+    if use_cache:
+        get_llm_cache().set(key, {'response': response_string, 'parsed': answer_parsed})
+    return dict(answer_parsed)
+
+
+def get_parsed_answers(prompt_generators, use_cache=True):
+    # get_parsed_answer for many prompts: the ones not cached are sent through the dispatcher concurrently.
+    # Answers come back in input order; None where the request or the parsing failed.
+    prompts = [prompt_generator.get_formatted_prompt().to_string() for prompt_generator in prompt_generators]
+    records = complete_prompts(prompts, use_cache)
+
+    answers = []
+    for prompt_generator, prompt, record in zip(prompt_generators, prompts, records):
+        if not isinstance(record, Exception) and record.get('parsed') is not None:
+            answers.append(dict(record['parsed']))
+            continue
+        response_string = record if isinstance(record, Exception) else record['response']
+        if isinstance(response_string, Exception):
+            answers.append(None)
+            continue
+        try:
+            answer_parsed = prompt_generator.get_output_parser().parse(response_string)
+        except ValueError:
+            answer_parsed = None
+        if use_cache and answer_parsed is not None:
+            get_llm_cache().set(prompt_key(prompt), {'response': response_string, 'parsed': answer_parsed})
+        answers.append(dict(answer_parsed) if answer_parsed is not None else None)
+    return answers
+
+
+def complete_prompts(prompts, use_cache=True):
+    # Cache records ({'response': ..., 'parsed': ...}) for many prompts, in input order. Prompts without a parsed
+    # answer in the cache are sent through the dispatcher concurrently, once each, and come back with parsed None
+    # (the caller caches them once they parse); a failed request gives its exception instead.
+    records = [get_llm_cache().get(prompt_key(prompt)) if use_cache else None for prompt in prompts]
+    records = [record if record is not None and record.get('parsed') is not None else None for record in records]
+    missing = list(dict.fromkeys(prompt for prompt, record in zip(prompts, records) if record is None))
+    responses = dict(zip(missing, get_dispatcher().run(missing, return_exceptions=True))) if missing else {}
+
+    completed = []
+    for prompt, record in zip(prompts, records):
+        if record is None:
+            response_string = responses[prompt]
+            record = response_string if isinstance(response_string, Exception) else \
+                {'response': response_string, 'parsed': None}
+        completed.append(record)
+    return completed
+
+
+# Sentences answered inside packed prompts, and those that had to fall back to a prompt of their own
+packing_counts = {"packed": 0, "fallback": 0, "prompts": 0}
+
+
+def pack_prompt_generators(prompt_generators, token_budget):
+    # Consecutive groups of sentences whose packed prompt fits the token budget (a sentence too long for the
+    # budget gets a group of its own). Each sentence's tokens are counted once and added to a running total.
+    groups = []
+    total = 0
+    for prompt_generator in prompt_generators:
+        if groups:
+            tokens = packed_sentence_tokens(len(groups[-1]) + 1, prompt_generator)
+            if total + tokens <= token_budget:
+                groups[-1].append(prompt_generator)
+                total += tokens
+                continue
+        groups.append([prompt_generator])
+        total = packed_base_tokens() + packed_sentence_tokens(1, prompt_generator)
+    return groups
+
+
+def get_packed_answers(prompt_generators, token_budget=3000, use_cache=True):
+    # Like get_parsed_answers, but several sentences share one prompt. Every sentence's Zhuyin is checked on its
+    # own; only the sentences that fail go out again as single-sentence prompts.
+    packed = [PackedPromptGenerator(group) for group in pack_prompt_generators(prompt_generators, token_budget)]
+    prompts = [packed_generator.get_formatted_prompt().to_string() for packed_generator in packed]
+    records = complete_prompts(prompts, use_cache)
+    packing_counts["prompts"] += len(packed)
+
+    answers = []
+    for packed_generator, prompt, record in zip(packed, prompts, records):
+        if isinstance(record, Exception):
+            zhuyins = [None] * len(packed_generator.prompt_generators)
+        elif record['parsed'] is not None:
+            zhuyins = record['parsed']
+        else:
+            # Cached once it answers at least one sentence; the others fall back to prompts of their own
+            zhuyins = packed_generator.parse(record['response'])
+            if use_cache and any(zhuyin is not None for zhuyin in zhuyins):
+                get_llm_cache().set(prompt_key(prompt), {'response': record['response'], 'parsed': zhuyins})
+        for prompt_generator, zhuyin in zip(packed_generator.prompt_generators, zhuyins):
+            valid = zhuyin is not None and check_zhuyin(prompt_generator.sentence, zhuyin)
+            answers.append({'zhuyin': zhuyin} if valid else None)
+
+    fallback = [i for i, answer in enumerate(answers) if answer is None]
+    packing_counts["packed"] += len(answers) - len(fallback)
+    packing_counts["fallback"] += len(fallback)
+    if fallback:
+        packing_counts["prompts"] += len(fallback)
+        for i, answer in zip(fallback, get_parsed_answers([prompt_generators[i] for i in fallback], use_cache)):
+            answers[i] = answer
+    return answers
+
+
+def check_zhuyin(sentence, zhuyin):
+    # One syllable per Chinese character, all of them convertible to braille
+    characters = sum(1 for char in sentence if '\u4e00' <= char <= '\u9fff')
+    if len(zhuyin_syllables(zhuyin)) != characters:
+        return False
+    try:
+        convert_zhuyin_to_braille(zhuyin)
+    except ValueError:
+        return False
+    return True
+
+
+# LLM answers checked against the dictionary readings: aligned as they came, repaired by asking again for the
+# misaligned words only, or still misaligned after that
+repair_counts = {"aligned": 0, "repaired": 0, "failed": 0}
+
+
+def repair_fractions():
+    total = sum(repair_counts.values())
+    return {outcome: count / total if total else 0.0 for outcome, count in repair_counts.items()}
+
+
+def repair_zhuyin(prompt_generator, zhuyin, use_cache=True):
+    return repair_zhuyins([prompt_generator], [zhuyin], use_cache)[0]
+
+
+def repair_zhuyins(prompt_generators, zhuyins, use_cache=True):
+    # Every answer whose syllables do not line up with its sentence's dictionary readings (a syllable dropped,
+    # merged or added, or a reading the word does not have) gets one SpanPromptGenerator for the misaligned
+    # words, sent concurrently; their answers are spliced in. An answer that is still misaligned is returned
+    # as it was.
+    spans = [misaligned_span(prompt_generator.preprocessed, zhuyin, prompt_generator.analysis.entries)
+             for prompt_generator, zhuyin in zip(prompt_generators, zhuyins)]
+    repairs = [i for i, span in enumerate(spans) if span is not None]
+    repair_counts["aligned"] += len(spans) - len(repairs)
+    span_generators = [SpanPromptGenerator(prompt_generators[i], spans[i][0], spans[i][1]) for i in repairs]
+    span_answers = get_parsed_answers(span_generators, use_cache) if span_generators else []
+
+    repaired = list(zhuyins)
+    for i, span_answer in zip(repairs, span_answers):
+        prompt_generator = prompt_generators[i]
+        if span_answer is not None:
+            start, end, first, last = spans[i]
+            candidate = splice_zhuyin(zhuyins[i], first, last, span_answer['zhuyin'],
+                                      span_layout(prompt_generator.preprocessed, start, end))
+            if misaligned_span(prompt_generator.preprocessed, candidate, prompt_generator.analysis.entries) is None:
+                repaired[i] = candidate
+                repair_counts["repaired"] += 1
+                continue
+        repair_counts["failed"] += 1
+    return repaired
+
+
+@metrics.timed("llm.completion")
+def request_completion(prompt):
+    metrics.increment("llm.requests")
+    messages = [{"role": "user", "content": prompt}]
+    output = openai.ChatCompletion.create(
+        model=model,
+        messages=messages,
+        **completion_parameters)
+
+    return output['choices'][0]['message']['content']
 
 
 def only_chinese(sentence):
@@ -0,0 +1,69 @@
+import csv
+
+from moedict_index import load_dump
+
+# Readings of every single-character dictionary entry, so characters with one reading need no dictionary lookup.
+# The file is a CSV (character, readings separated by "|", variant target), small enough to load into a dict.
+columns = ["character", "readings", "variant"]
+
+
+def build_char_index(dump_path, index_path):
+    # Readings as get_pronunciations_for_word gives them, the variant target as get_variant finds it
+    from moedict_api import get_pronunciations_for_word, get_variant
+
+    entries = load_dump(dump_path)
+    characters = sorted(title for title in entries if len(title) == 1)
+    with open(index_path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for character in characters:
+            entry = entries[character]
+            writer.writerow([character, "|".join(get_pronunciations_for_word(entry)), get_variant(entry) or ""])
+    return len(characters)
+
+
+class CharIndex:
+    def __init__(self, path):
+        # {character: (readings, variant target or None, polyphone)}
+        self.characters = {}
+        with open(path, encoding="utf-8", newline="") as f:
+            for row in csv.DictReader(f):
+                readings = tuple(row["readings"].split("|")) if row["readings"] else ()
+                self.characters[row["character"]] = (readings, row["variant"] or None, len(readings) > 1)
+
+    def __len__(self):
+        return len(self.characters)
+
+    def __contains__(self, character):
+        return character in self.characters
+
+    def readings(self, character):
+        # The character's own readings, as find_pronunciation_for_sentence uses them, if it has at most one;
+        # None for polyphones and characters not in the index, which need the full dictionary entry
+        if character not in self.characters:
+            return None
+        readings, variant, polyphone = self.characters[character]
+        return None if polyphone else list(readings)
+
+    def resolved_readings(self, character):
+        # Same for add_pronunciations, which reads a variant character as the character it points to
+        if character not in self.characters:
+            return None
+        readings, variant, polyphone = self.characters[character]
+        if variant:
+            return self.readings(variant)
+        return None if polyphone else list(readings)
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build the single-character reading index from a moedict dump.")
+    parser.add_argument("dump", help="moedict JSON dump, e.g. dict-revised.json")
+    parser.add_argument("index", help="CSV file to write, e.g. moedict_chars.csv")
+    args = parser.parse_args(argv)
+    print(f"Indexed {build_char_index(args.dump, args.index)} characters")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import metrics
+from braille_converter import convert_zhuyin_to_braille, get_syllable_table
+from cc_main import get_dispatcher, get_formatted_zhuyin_and_braille, get_llm_cache, get_zhuyins, only_chinese
+from moedict_api import get_cache, get_fetcher, get_nlp
+
+
+# Long-running HTTP conversion service: the spaCy model, the braille tables, the caches and the connection pools
+# are loaded once and shared by a pool of worker threads.
+#   POST /convert        {"sentence": "..."}          -> {"sentence", "zhuyin", "braille", "prompt"}
+#   POST /convert_batch  {"sentences": ["...", ...]}  -> {"results": [...]}, an "error" in place of failed ones
+#   GET  /health, GET /metrics (Prometheus text, see metrics.py)
+# At most workers conversions run at once and queue_size more wait; any further request gets 503 at once.
+
+
+class QueueFull(Exception):
+    pass
+
+
+def warm_up():
+    get_nlp()
+    get_syllable_table()
+    get_cache()
+    get_fetcher()
+    get_llm_cache()
+    get_dispatcher()
+
+
+class ConversionService:
+    def __init__(self, workers=4, queue_size=16, fast_path=True, pack_tokens=None, max_batch=256):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.fast_path = fast_path
+        self.pack_tokens = pack_tokens
+        self.max_batch = max_batch
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="conversion")
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    def submit(self, function, *args):
+        # function(*args) run on the worker pool; raises QueueFull instead of waiting when the queue is full
+        if not self.slots.acquire(blocking=False):
+            metrics.increment("service.rejected")
+            raise QueueFull()
+        with self.lock:
+            self.in_flight += 1
+        try:
+            with metrics.timer("service.request"):
+                return self.executor.submit(function, *args).result()
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+            self.slots.release()
+
+    def convert(self, sentence):
+        # Single sentences use the synchronous completion call, so they run in parallel on the workers
+        if not only_chinese(sentence):
+            raise ValueError("Not only traditional Chinese characters: " + sentence)
+        prompt, answer = get_formatted_zhuyin_and_braille(sentence, fast_path=self.fast_path)
+        return {"sentence": sentence, "zhuyin": answer['zhuyin'], "braille": answer['braille'], "prompt": prompt}
+
+    def convert_batch(self, sentences):
+        results = []
+        for sentence, result in zip(sentences, get_zhuyins(sentences, fast_path=self.fast_path,
+                                                           pack_tokens=self.pack_tokens)):
+            if isinstance(result, Exception):
+                results.append({"sentence": sentence, "error": str(result)})
+                continue
+            prompt, answer = result
+            try:
+                braille = convert_zhuyin_to_braille(answer['zhuyin'])
+            except ValueError as e:
+                results.append({"sentence": sentence, "error": str(e)})
+                continue
+            results.append({"sentence": sentence, "zhuyin": answer['zhuyin'], "braille": braille, "prompt": prompt})
+        return results
+
+    def health(self):
+        return {"status": "ok", "in_flight": self.in_flight, "workers": self.workers, "queue_size": self.queue_size}
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class ConversionServer(ThreadingHTTPServer):
+    # Connections beyond the listen backlog wait for TCP retransmits instead of getting a quick 503
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class ConversionHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == "/health":
+            self.send_json(200, service.health())
+        elif self.path == "/metrics":
+            body = metrics.prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        service = self.server.service
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        except ValueError:
+            self.send_json(400, {"error": "the body is not JSON"})
+            return
+
+        try:
+            if self.path == "/convert":
+                sentence = request.get("sentence") if isinstance(request, dict) else None
+                if not isinstance(sentence, str) or not sentence:
+                    self.send_json(400, {"error": "expected {\"sentence\": \"...\"}"})
+                    return
+                # 400 is kept for bad input: a ValueError from the conversion itself (an unparsable LLM answer,
+                # Zhuyin without braille) is a 500
+                if not only_chinese(sentence):
+                    self.send_json(400, {"error": "Not only traditional Chinese characters: " + sentence})
+                    return
+                self.send_json(200, service.submit(service.convert, sentence))
+            elif self.path == "/convert_batch":
+                sentences = request.get("sentences") if isinstance(request, dict) else None
+                if not isinstance(sentences, list) or not all(isinstance(sentence, str) for sentence in sentences):
+                    self.send_json(400, {"error": "expected {\"sentences\": [\"...\", ...]}"})
+                    return
+                if len(sentences) > service.max_batch:
+                    self.send_json(413, {"error": f"at most {service.max_batch} sentences per batch"})
+                    return
+                self.send_json(200, {"results": service.submit(service.convert_batch, sentences)})
+            else:
+                self.send_json(404, {"error": "not found"})
+        except QueueFull:
+            self.send_json(503, {"error": "too many requests waiting, try again"}, {"Retry-After": "1"})
+        except Exception as e:
+            self.send_json(500, {"error": str(e)})
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_service(service, host="127.0.0.1", port=8080):
+    # Serves on a daemon thread; returns the server and its base URL
+    server = ConversionServer((host, port), ConversionHandler)
+    server.service = service
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve Zhuyin and braille conversion over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=4, help="conversions running at once")
+    parser.add_argument("--queue-size", type=int, default=16, help="requests waiting before 503 is returned")
+    parser.add_argument("--max-batch", type=int, default=256, help="sentences per /convert_batch request")
+    parser.add_argument("--pack-tokens", type=int, default=None, help="pack batch prompts up to this many tokens")
+    parser.add_argument("--always-llm", action="store_true", help="ask the LLM even when no character is ambiguous")
+    args = parser.parse_args(argv)
+
+    warm_up()
+    service = ConversionService(args.workers, args.queue_size, fast_path=not args.always_llm,
+                                pack_tokens=args.pack_tokens, max_batch=args.max_batch)
+    server, url = start_service(service, args.host, args.port)
+    print(f"Serving conversions at {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+        service.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+import csv
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from itertools import islice
+
+import metrics
+from braille_converter import convert_zhuyin_to_braille, zhuyin_syllables
+from cc_main import get_zhuyins, packing_counts, path_fractions, repair_fractions
+from moedict_api import iter_tag_chinese_sentences
+
+# Same columns as testdata.tsv
+columns = ['sentence', 'target', 'target_zhuyin', 'target_braille', 'target_pos']
+
+
+def read_sentences(path):
+    # A TSV with a sentence column (target and target_pos are optional), or plain text with one sentence per line
+    with open(path, encoding="utf-8", newline="") as f:
+        if path.endswith(".tsv"):
+            return [row for row in csv.DictReader(f, delimiter='\t') if row['sentence'].strip()]
+        return [{'sentence': line.strip()} for line in f if line.strip()]
+
+
+def count_done(output_path):
+    # Number of rows already written by an earlier run (every row is one line, see convert_batch); a half-written
+    # last line is cut off
+    if not os.path.exists(output_path):
+        return 0
+    with open(output_path, "rb+") as f:
+        content = f.read()
+        if content and not content.endswith(b"\n"):
+            content = content[:content.rfind(b"\n") + 1]
+            f.seek(0)
+            f.truncate()
+            f.write(content)
+    return max(content.count(b"\n") - 1, 0)
+
+
+def target_zhuyin(sentence, zhuyin, target_pos):
+    # The syllable read for the character at target_pos, counting only Chinese characters
+    index = sum(1 for char in sentence[:target_pos] if '\u4e00' <= char <= '\u9fff')
+    syllables = zhuyin_syllables(zhuyin)
+    if index < len(syllables):
+        return syllables[index]
+    return ''
+
+
+def convert_or_none(zhuyin):
+    # None if the converter cannot read the zhuyin (e.g. an LLM answer with a lone "…")
+    try:
+        return convert_zhuyin_to_braille(zhuyin)
+    except ValueError:
+        return None
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    batch = list(islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, size))
+
+
+def failed_path(output_path):
+    # Input row numbers (from 0) of the sentences that failed, one per line, kept next to the output
+    return output_path + ".failed"
+
+
+def read_failed(output_path):
+    if not os.path.exists(failed_path(output_path)):
+        return set()
+    with open(failed_path(output_path), encoding="utf-8") as f:
+        return {int(line) for line in f if line.strip()}
+
+
+def append_failed(output_path, indices):
+    with open(failed_path(output_path), "a", encoding="utf-8") as f:
+        f.writelines(f"{i}\n" for i in indices)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def one_line(value):
+    # A newline in a value (e.g. in an LLM answer) would make the row two lines and throw off count_done
+    return ' '.join(str(value).splitlines())
+
+
+def convert_batch(batch, tagged=None, fast_path=True, pack_tokens=None, pool=None):
+    # Output lines for a batch of input rows, and the positions in the batch of the failed sentences, which get
+    # an empty zhuyin and braille. A target past the end of the answer also gives an empty zhuyin but is not a
+    # failure: asking again would replay the same cached answer.
+    sentences = [row['sentence'] for row in batch]
+
+    # One dictionary fetch for the whole batch and prompts only for sentences with polyphones, sent to the LLM
+    # concurrently
+    zhuyins = [''] * len(batch)
+    for i, (sentence, result) in enumerate(zip(sentences, get_zhuyins(sentences, tagged, fast_path, pack_tokens))):
+        if isinstance(result, Exception):
+            print(f"Skipping {sentence}: {result}", file=sys.stderr)
+        else:
+            zhuyins[i] = result[1]['zhuyin']
+
+    # The target syllable where the input names a target, otherwise the whole sentence
+    outputs = []
+    for row, zhuyin in zip(batch, zhuyins):
+        if row.get('target') and row.get('target_pos'):
+            outputs.append((row['target'], target_zhuyin(row['sentence'], zhuyin, int(row['target_pos'])),
+                            row['target_pos']))
+        else:
+            outputs.append((row['sentence'], zhuyin, 0))
+
+    if pool is not None:
+        brailles = list(pool.map(convert_or_none, [zhuyin for _, zhuyin, _ in outputs]))
+    else:
+        brailles = [convert_or_none(zhuyin) for _, zhuyin, _ in outputs]
+
+    lines = []
+    failed = []
+    for i, (row, (target, zhuyin, target_pos), braille) in enumerate(zip(batch, outputs, brailles)):
+        if braille is None:
+            print(f"Skipping {row['sentence']}: no braille for {zhuyin}", file=sys.stderr)
+        if not zhuyins[i] or braille is None:
+            failed.append(i)
+            zhuyin, braille = '', ''
+        lines.append([one_line(value) for value in (row['sentence'], target, zhuyin, braille, target_pos)])
+    return lines, failed
+
+
+def retry_failed(output_path, rows, batch_size=32, fast_path=True, pack_tokens=None, pool=None):
+    # The sentences an earlier run failed on (e.g. during a moedict or LLM outage) are converted again, and the
+    # output is rewritten if any of them succeed. Returns how many still fail.
+    failed = sorted(i for i in read_failed(output_path) if i < len(rows))
+    if not failed:
+        return 0
+    with open(output_path, encoding="utf-8", newline="") as f:
+        lines = list(csv.reader(f, delimiter='\t'))[1:]
+    still_failed = []
+    for indices in batches(failed, batch_size):
+        new_lines, batch_failed = convert_batch([rows[i] for i in indices], None, fast_path, pack_tokens, pool)
+        for position, (i, line) in enumerate(zip(indices, new_lines)):
+            if position in batch_failed:
+                still_failed.append(i)
+            else:
+                lines[i] = line
+    if len(still_failed) < len(failed):
+        with open(output_path + ".tmp", "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+            writer.writerow(columns)
+            writer.writerows(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(output_path + ".tmp", output_path)
+    with open(failed_path(output_path) + ".tmp", "w", encoding="utf-8") as f:
+        f.writelines(f"{i}\n" for i in still_failed)
+    os.replace(failed_path(output_path) + ".tmp", failed_path(output_path))
+    return len(still_failed)
+
+
+def run_pipeline(input_path, output_path, batch_size=32, processes=1, resume=True, fast_path=True, pack_tokens=None):
+    # pack_tokens packs the batch's sentences into shared prompts of at most that many tokens. Returns the number
+    # of rows written and how many of them failed; rerunning retries the failed ones.
+    rows = read_sentences(input_path)
+    done = count_done(output_path) if resume else 0
+    todo = rows[done:]
+    if not done and os.path.exists(failed_path(output_path)):
+        os.remove(failed_path(output_path))
+
+    pool = ProcessPoolExecutor(processes) if processes > 1 else None
+    try:
+        failed = retry_failed(output_path, rows[:done], batch_size, fast_path, pack_tokens, pool) if done else 0
+        if not todo:
+            return done, failed
+
+        tagged_sentences = iter_tag_chinese_sentences((row['sentence'] for row in todo), batch_size=batch_size,
+                                                      n_process=processes)
+        with open(output_path, "a" if done else "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+            if not done:
+                writer.writerow(columns)
+            for batch in batches(todo, batch_size):
+                # Tagging (nlp.pipe, n_process workers) runs ahead of the batch
+                tagged = list(islice(tagged_sentences, len(batch)))
+                lines, batch_failed = convert_batch(batch, tagged, fast_path, pack_tokens, pool)
+                # Failures are recorded before their rows, so a crash in between cannot lose them
+                append_failed(output_path, [done + i for i in batch_failed])
+                writer.writerows(lines)
+                f.flush()
+                os.fsync(f.fileno())
+                done += len(batch)
+                failed += len(batch_failed)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return done, failed
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Convert a file of sentences to Zhuyin and braille.")
+    parser.add_argument("input", help="TSV with a sentence column (like testdata.tsv) or text, one sentence per line")
+    parser.add_argument("output", help="TSV to write, in the testdata.tsv layout")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--processes", type=int, default=1, help="worker processes for tagging and braille")
+    parser.add_argument("--restart", action="store_true", help="ignore rows already in the output")
+    parser.add_argument("--always-llm", action="store_true", help="ask the LLM even when no character is ambiguous")
+    parser.add_argument("--pack-tokens", type=int, default=None,
+                        help="pack several sentences into prompts of up to this many tokens")
+    parser.add_argument("--metrics", metavar="PATH",
+                        help="write stage timings and counters here in the Prometheus text format ('-' for stdout)")
+    parser.add_argument("--profile", metavar="PATH", help="run under cProfile and save the stats here")
+    args = parser.parse_args(argv)
+
+    if args.metrics:
+        metrics.configure_metrics(True)
+    with metrics.profiled(args.profile) if args.profile else nullcontext():
+        done, failed = run_pipeline(args.input, args.output, args.batch_size, args.processes,
+                                    resume=not args.restart, fast_path=not args.always_llm,
+                                    pack_tokens=args.pack_tokens)
+    print(f"{done} sentences written to {args.output}")
+    if failed:
+        print(f"{failed} of them failed and were written without Zhuyin; rerun to retry them")
+    print(", ".join(f"{path}: {fraction:.0%}" for path, fraction in path_fractions().items()))
+    print("LLM answers " + ", ".join(f"{outcome}: {fraction:.0%}" for outcome, fraction in repair_fractions().items()))
+    if args.pack_tokens:
+        print(f"packed: {packing_counts['packed']}, fallback: {packing_counts['fallback']}, "
+              f"prompts: {packing_counts['prompts']}")
+    if args.metrics == "-":
+        print(metrics.prometheus_text(), end="")
+    elif args.metrics:
+        with open(args.metrics, "w", encoding="utf-8") as f:
+            f.write(metrics.prometheus_text())
+
+
+if __name__ == '__main__':
+    main()
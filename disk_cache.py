@@ -0,0 +1,175 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class DiskCache:
+    # SQLite-backed key/value store for JSON values with LRU eviction, optional TTL and a read-only mode.
+    # Safe to share between threads; several processes may use the same file.
+    # Hits do not write: their access times are kept in memory and written in one transaction once
+    # access_batch of them have piled up, access_interval seconds have passed, or the cache is written to.
+    access_batch = 256
+    access_interval = 30.0
+
+    def __init__(self, path, max_entries=None, ttl=None, read_only=False):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.pending_accesses = {}
+        self.accesses_written = time.monotonic()
+
+        if read_only and not os.path.exists(path):
+            self.connection = sqlite3.connect(":memory:", check_same_thread=False)
+        elif read_only:
+            self.connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+        if not read_only or path == ":memory:" or not os.path.exists(path):
+            self.connection.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                                    "created REAL NOT NULL, accessed REAL NOT NULL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+            self.connection.commit()
+
+    def get(self, key, default=None):
+        with self.lock:
+            row = self.connection.execute("SELECT value, created FROM cache WHERE key = ?", (key,)).fetchone()
+            now = time.time()
+            if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                if not self.read_only:
+                    self.connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+                    self.connection.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.record_accesses([key], now)
+            return json.loads(row[0])
+
+    def set(self, key, value):
+        if self.read_only:
+            return
+        with self.lock:
+            now = time.time()
+            value = json.dumps(value, ensure_ascii=False)
+            self.write_accesses()
+            self.connection.execute("INSERT OR REPLACE INTO cache (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                                    (key, value, now, now))
+            self.evict()
+            self.connection.commit()
+
+    def get_many(self, keys):
+        # {key: value} for the keys present, in one transaction per chunk of keys instead of one per key
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        with self.lock:
+            now = time.time()
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self.connection.execute(f"SELECT key, value, created FROM cache WHERE key IN ({placeholders})",
+                                               chunk).fetchall()
+                expired = []
+                for key, value, created in rows:
+                    if self.ttl is not None and now - created > self.ttl:
+                        expired.append(key)
+                    else:
+                        found[key] = json.loads(value)
+                if expired and not self.read_only:
+                    self.connection.execute(f"DELETE FROM cache WHERE key IN ({','.join('?' * len(expired))})",
+                                            expired)
+                    self.connection.commit()
+            self.record_accesses(found, now)
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def set_many(self, items):
+        # set for many (key, value) pairs in one transaction
+        if self.read_only:
+            return
+        with self.lock:
+            now = time.time()
+            self.write_accesses()
+            self.connection.executemany("INSERT OR REPLACE INTO cache (key, value, created, accessed) "
+                                        "VALUES (?, ?, ?, ?)",
+                                        [(key, json.dumps(value, ensure_ascii=False), now, now)
+                                         for key, value in items])
+            self.evict()
+            self.connection.commit()
+
+    def record_accesses(self, keys, now):
+        # Called with the lock held, after hits
+        if self.read_only:
+            return
+        for key in keys:
+            self.pending_accesses[key] = now
+        if len(self.pending_accesses) >= self.access_batch or \
+                time.monotonic() - self.accesses_written >= self.access_interval:
+            self.write_accesses()
+            self.connection.commit()
+
+    def write_accesses(self):
+        # Called with the lock held; the caller commits. Keys deleted meanwhile (e.g. by another process) are
+        # simply not updated
+        if self.pending_accesses:
+            self.connection.executemany("UPDATE cache SET accessed = ? WHERE key = ?",
+                                        [(now, key) for key, now in self.pending_accesses.items()])
+            self.pending_accesses = {}
+        self.accesses_written = time.monotonic()
+
+    def evict(self):
+        # Called with the lock held, inside the write transaction: the count comes from the file, so entries other
+        # processes added are counted too
+        if self.max_entries is None:
+            return
+        size = self.connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        if size > self.max_entries:
+            self.connection.execute("DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed LIMIT ?)",
+                                    (size - self.max_entries,))
+
+    def __contains__(self, key):
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM cache WHERE key = ?", (key,)).fetchone() is not None
+
+    def items(self):
+        # Every (key, value), oldest first, e.g. to save the cache's contents as a recording
+        with self.lock:
+            rows = self.connection.execute("SELECT key, value FROM cache ORDER BY created").fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def clear(self):
+        if self.read_only:
+            return
+        with self.lock:
+            self.pending_accesses = {}
+            self.connection.execute("DELETE FROM cache")
+            self.connection.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+    def close(self):
+        with self.lock:
+            if not self.read_only:
+                self.write_accesses()
+                self.connection.commit()
+            self.connection.close()
@@ -0,0 +1,160 @@
+import csv
+import difflib
+import hashlib
+import json
+import os
+import sys
+
+import cc_main
+import prompt_generation
+from braille_converter import convert_zhuyin_to_braille
+from cc_main import get_zhuyins
+from disk_cache import DiskCache
+
+# Incremental conversion of long documents: the document is split into sentences and every sentence's Zhuyin
+# and braille are stored under a hash of the sentence, the model and the prompt settings (version, compact
+# prompts and their token budget, packing). Converting an edited document again only sends the new or changed
+# sentences through spaCy, moedict and the LLM.
+
+# A sentence ends after these, together with any closing quotes or brackets right after them, or at a line break
+end_punctuation = ['。', '？', '！', '；', '……']
+closing_punctuation = ['」', '』', '）', '》', '〉']
+columns = ['sentence', 'zhuyin', 'braille']
+
+
+def split_sentences(text):
+    sentences = []
+    for line in text.splitlines():
+        start = 0
+        i = 0
+        while i < len(line):
+            end = next((p for p in end_punctuation if line.startswith(p, i)), None)
+            if end is None:
+                i += 1
+                continue
+            i += len(end)
+            while i < len(line):
+                mark = line[i] if line[i] in closing_punctuation else \
+                    next((p for p in end_punctuation if line.startswith(p, i)), None)
+                if mark is None:
+                    break
+                i += len(mark)
+            sentences.append(line[start:i])
+            start = i
+        sentences.append(line[start:])
+    return [sentence.strip() for sentence in sentences if sentence.strip()]
+
+
+def sentence_key(sentence, pack_tokens=None):
+    key = json.dumps({"sentence": sentence, "model": cc_main.model,
+                      "prompt_version": prompt_generation.prompt_version,
+                      "compact": prompt_generation.compact_prompts,
+                      "token_budget": prompt_generation.prompt_token_budget if prompt_generation.compact_prompts
+                      else None,
+                      "pack_tokens": pack_tokens},
+                     sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def convert_document(text, store, batch_size=32, fast_path=True, pack_tokens=None):
+    # One {'sentence', 'zhuyin', 'braille', 'status'} per sentence of text, in order. status is "stored" for
+    # sentences found in store, "converted" for the ones converted now (and stored), "failed" for the others.
+    sentences = split_sentences(text)
+    keys = [sentence_key(sentence, pack_tokens) for sentence in sentences]
+    stored = store.get_many(keys)
+
+    dirty = list(dict.fromkeys(sentence for sentence, key in zip(sentences, keys) if key not in stored))
+    converted = {}
+    errors = {}
+    for start in range(0, len(dirty), batch_size):
+        batch = dirty[start:start + batch_size]
+        new_records = []
+        for sentence, result in zip(batch, get_zhuyins(batch, fast_path=fast_path, pack_tokens=pack_tokens)):
+            try:
+                if isinstance(result, Exception):
+                    raise result
+                zhuyin = result[1]['zhuyin']
+                record = {'zhuyin': zhuyin, 'braille': convert_zhuyin_to_braille(zhuyin)}
+            except Exception as e:
+                errors[sentence] = str(e)
+                continue
+            converted[sentence] = record
+            new_records.append((sentence_key(sentence, pack_tokens), record))
+        store.set_many(new_records)
+
+    rows = []
+    for sentence, key in zip(sentences, keys):
+        if key in stored:
+            rows.append({'sentence': sentence, **stored[key], 'status': 'stored'})
+        elif sentence in converted:
+            rows.append({'sentence': sentence, **converted[sentence], 'status': 'converted'})
+        else:
+            rows.append({'sentence': sentence, 'zhuyin': '', 'braille': '', 'status': 'failed',
+                         'error': errors.get(sentence, '')})
+    return rows
+
+
+def read_output(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8", newline="") as f:
+        return list(csv.DictReader(f, delimiter='\t'))
+
+
+def write_output(path, rows):
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow([row[column] for column in columns])
+
+
+def diff_rows(old_rows, new_rows, old_name="before", new_name="after"):
+    # Unified diff of the sentence/braille lines of two conversions of a document
+    def lines(rows):
+        return [f"{row['sentence']}\t{row['braille']}\n" for row in rows]
+    return ''.join(difflib.unified_diff(lines(old_rows), lines(new_rows), old_name, new_name))
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Convert a document, reusing the sentences converted before.")
+    parser.add_argument("input", help="text document")
+    parser.add_argument("output", help="TSV with one sentence, its Zhuyin and its braille per row; "
+                                       "a previous conversion there is compared with the new one")
+    parser.add_argument("--store", default=os.environ.get("CONVERSION_STORE", "conversions.sqlite"),
+                        help="SQLite file keeping every converted sentence")
+    parser.add_argument("--diff", metavar="PATH", help="write the diff against the previous output here "
+                                                        "instead of stdout")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--pack-tokens", type=int, default=None,
+                        help="pack several sentences into prompts of up to this many tokens")
+    parser.add_argument("--always-llm", action="store_true", help="ask the LLM even when no character is ambiguous")
+    args = parser.parse_args(argv)
+
+    with open(args.input, encoding="utf-8") as f:
+        text = f.read()
+    store = DiskCache(args.store)
+    previous = read_output(args.output)
+    rows = convert_document(text, store, args.batch_size, fast_path=not args.always_llm,
+                            pack_tokens=args.pack_tokens)
+    store.close()
+    write_output(args.output, rows)
+
+    for row in rows:
+        if row['status'] == 'failed':
+            print(f"Failed {row['sentence']}: {row['error']}", file=sys.stderr)
+    counts = {status: sum(row['status'] == status for row in rows) for status in ('stored', 'converted', 'failed')}
+    print(f"{len(rows)} sentences: " + ", ".join(f"{count} {status}" for status, count in counts.items()),
+          file=sys.stderr)
+    diff = diff_rows(previous, rows, args.output + " (before)", args.output)
+    if args.diff:
+        with open(args.diff, "w", encoding="utf-8") as f:
+            f.write(diff)
+    else:
+        sys.stdout.write(diff)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+import asyncio
+import random
+import threading
+import time
+
+import openai
+
+import metrics
+from token_count import count_tokens
+
+retryable_errors = (openai.error.RateLimitError, openai.error.ServiceUnavailableError, openai.error.Timeout,
+                    openai.error.APIConnectionError, openai.error.TryAgain)
+
+
+class RateLimiter:
+    # Token bucket refilled continuously at rate_per_minute, holding at most one minute's worth
+    def __init__(self, rate_per_minute):
+        self.rate_per_minute = rate_per_minute
+        self.available = rate_per_minute
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, amount=1):
+        amount = min(amount, self.rate_per_minute)
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.available = min(self.rate_per_minute,
+                                     self.available + (now - self.updated) * self.rate_per_minute / 60)
+                self.updated = now
+                if self.available >= amount:
+                    self.available -= amount
+                    return
+                await asyncio.sleep((amount - self.available) * 60 / self.rate_per_minute)
+
+
+class CompletionDispatcher:
+    # Keeps up to max_in_flight chat completions running at once within the requests-per-minute and
+    # tokens-per-minute budgets; rate limits, 5xx and connection errors are retried with jittered backoff
+    def __init__(self, model="gpt-4", parameters=None, max_in_flight=8, requests_per_minute=500,
+                 tokens_per_minute=40000, max_retries=6, backoff=1.0, max_backoff=60.0):
+        self.model = model
+        self.parameters = parameters if parameters is not None else {"max_tokens": 1500, "temperature": 0}
+        self.max_in_flight = max_in_flight
+        self.request_limiter = RateLimiter(requests_per_minute) if requests_per_minute else None
+        self.token_limiter = RateLimiter(tokens_per_minute) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.requests_sent = 0
+        self.retries = 0
+        # The rate limiters belong to one event loop at a time: runs from several threads take turns
+        self.run_lock = threading.Lock()
+
+    async def complete(self, prompt, semaphore):
+        tokens = count_tokens(prompt, self.model) + self.parameters.get("max_tokens", 0)
+        async with semaphore:
+            for attempt in range(self.max_retries + 1):
+                if self.request_limiter is not None:
+                    await self.request_limiter.acquire()
+                if self.token_limiter is not None:
+                    await self.token_limiter.acquire(tokens)
+                try:
+                    self.requests_sent += 1
+                    metrics.increment("llm.requests")
+                    with metrics.timer("llm.completion"):
+                        output = await openai.ChatCompletion.acreate(
+                            model=self.model,
+                            messages=[{"role": "user", "content": prompt}],
+                            **self.parameters)
+                    return output['choices'][0]['message']['content']
+                except openai.error.OpenAIError as e:
+                    server_error = isinstance(e, openai.error.APIError) and (e.http_status or 500) >= 500
+                    if attempt == self.max_retries or not (isinstance(e, retryable_errors) or server_error):
+                        raise
+                    self.retries += 1
+                    metrics.increment("llm.retries")
+                    await asyncio.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+
+    async def complete_all(self, prompts, return_exceptions=False):
+        # Responses in the order of prompts; with return_exceptions, a prompt that failed gets its exception
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        for limiter in (self.request_limiter, self.token_limiter):
+            if limiter is not None:
+                limiter.lock = asyncio.Lock()
+        return await asyncio.gather(*(self.complete(prompt, semaphore) for prompt in prompts),
+                                    return_exceptions=return_exceptions)
+
+    def run(self, prompts, return_exceptions=False):
+        with self.run_lock:
+            return asyncio.run(self.complete_all(prompts, return_exceptions))
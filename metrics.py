@@ -0,0 +1,167 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+
+# Timers, counters and histograms for the conversion pipeline. Off unless METRICS=1 or configure_metrics(True):
+# a disabled timer costs one flag check, so the instrumented functions can stay instrumented in production.
+# Everything is per process (braille conversion in corpus_pipeline's worker processes is not counted).
+enabled = os.environ.get("METRICS") == "1"
+
+# Upper bounds of the histogram buckets, in seconds
+buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+counters = {}
+histograms = {}
+lock = threading.Lock()
+disabled_timer = nullcontext()
+
+
+def configure_metrics(enable=True):
+    global enabled
+    enabled = enable
+
+
+class Histogram:
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.bucket_counts = [0] * (len(buckets) + 1)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+                break
+        else:
+            self.bucket_counts[-1] += 1
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "min": self.min,
+            "max": self.max,
+            "buckets": dict(zip([str(bound) for bound in buckets] + ["+Inf"], self.bucket_counts))
+        }
+
+
+def increment(name, amount=1):
+    if not enabled:
+        return
+    with lock:
+        counters[name] = counters.get(name, 0) + amount
+
+
+def observe(name, value):
+    if not enabled:
+        return
+    with lock:
+        if name not in histograms:
+            histograms[name] = Histogram()
+        histograms[name].observe(value)
+
+
+class Timer:
+    # Observes the seconds spent in the block in the histogram name
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def timer(name):
+    return Timer(name) if enabled else disabled_timer
+
+
+def timed(name):
+    # Decorator: every call is observed in the histogram name
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with Timer(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def snapshot():
+    with lock:
+        return {
+            "time": time.time(),
+            "counters": dict(counters),
+            "histograms": {name: histogram.summary() for name, histogram in histograms.items()}
+        }
+
+
+def reset():
+    with lock:
+        counters.clear()
+        histograms.clear()
+
+
+def write_log(stream=None):
+    # The snapshot as one JSON line, for structured logs
+    stream = stream if stream is not None else sys.stderr
+    stream.write(json.dumps(snapshot(), ensure_ascii=False) + "\n")
+    stream.flush()
+
+
+def prometheus_name(name):
+    return "gpt_taiwan_braille_" + "".join(char if char.isalnum() else "_" for char in name)
+
+
+def prometheus_text():
+    # The Prometheus text exposition format: counters as <name>_total, timers as <name>_seconds histograms
+    current = snapshot()
+    lines = []
+    for name, value in sorted(current["counters"].items()):
+        metric = prometheus_name(name) + "_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric} {value}")
+    for name, histogram in sorted(current["histograms"].items()):
+        metric = prometheus_name(name) + "_seconds"
+        lines.append(f"# TYPE {metric} histogram")
+        cumulative = 0
+        for bound, count in histogram["buckets"].items():
+            cumulative += count
+            lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f"{metric}_sum {histogram['sum']}")
+        lines.append(f"{metric}_count {histogram['count']}")
+    return "\n".join(lines) + "\n"
+
+
+@contextmanager
+def profiled(path=None, sort="cumulative", limit=30):
+    # cProfile around the block: the stats go to path (for pstats or snakeviz), or the top functions to stderr
+    import cProfile
+    import pstats
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if path:
+            profiler.dump_stats(path)
+        else:
+            pstats.Stats(profiler, stream=sys.stderr).sort_stats(sort).print_stats(limit)
@@ -1,44 +1,215 @@
-import spacy
-import requests
+import os
+import metrics
+from char_index import CharIndex
+from disk_cache import DiskCache
+from moedict_fetch import MoedictFetcher
+from moedict_index import MoedictIndex
 
-# Load the Chinese model
-nlp = spacy.load("zh_core_web_sm")
+# The Chinese model is loaded on first use, without the parser and NER. token.pos_ needs the tagger and the
+# attribute_ruler that maps its tags to universal POS tags.
+nlp = None
 
 
-def get_all_pronunciations(input_string):
+def get_nlp():
+    global nlp
+    if nlp is None:
+        import spacy
+        with metrics.timer("spacy.load"):
+            nlp = spacy.load("zh_core_web_sm", exclude=["parser", "ner"])
+    return nlp
+
+moedict_url = os.environ.get("MOEDICT_URL", "https://www.moedict.tw/uni/")
+
+# Every moedict lookup goes through this cache; see configure_cache
+cache = None
+offline = os.environ.get("MOEDICT_OFFLINE") == "1"
+
+# Local index built by moedict_index.py; when set, it replaces both the cache and the network
+index = MoedictIndex(os.environ["MOEDICT_INDEX"]) if os.environ.get("MOEDICT_INDEX") else None
+
+# Readings of single characters built by char_index.py; characters with one reading are then never looked up
+char_index = CharIndex(os.environ["MOEDICT_CHAR_INDEX"]) if os.environ.get("MOEDICT_CHAR_INDEX") else None
+
+
+def configure_cache(path="moedict_cache.sqlite", max_entries=200000, ttl=None, read_only=False, offline_mode=False):
+    # offline_mode never touches the network: words missing from the cache are treated as not in the dictionary
+    global cache, offline
+    if cache is not None:
+        cache.close()
+    cache = DiskCache(path, max_entries=max_entries, ttl=ttl, read_only=read_only)
+    offline = offline_mode
+    return cache
+
+
+def get_cache():
+    if cache is None:
+        configure_cache(os.environ.get("MOEDICT_CACHE", "moedict_cache.sqlite"), offline_mode=offline)
+    return cache
+
+
+def cache_stats():
+    return get_cache().stats()
+
+
+# Shared connection pool for all network lookups; see configure_fetcher
+fetcher = None
+
+
+def configure_fetcher(base_url=None, max_workers=8, retries=3, backoff_factor=0.5, timeout=10):
+    global fetcher
+    if fetcher is not None:
+        fetcher.close()
+    fetcher = MoedictFetcher(base_url or moedict_url, max_workers=max_workers, retries=retries,
+                             backoff_factor=backoff_factor, timeout=timeout)
+    return fetcher
+
+
+def get_fetcher():
+    if fetcher is None:
+        configure_fetcher(max_workers=int(os.environ.get("MOEDICT_CONCURRENCY", 8)))
+    return fetcher
+
+
+def use_index(path):
+    global index
+    if index is not None:
+        index.close()
+    index = MoedictIndex(path) if path else None
+    return index
+
+
+def use_char_index(path):
+    global char_index
+    char_index = CharIndex(path) if path else None
+    return char_index
+
+
+def needs_entry(token):
+    # False for single characters the character index settles, so batch prefetches can leave them out
+    return char_index is None or len(token) != 1 or char_index.readings(token) is None
+
+
+@metrics.timed("moedict.fetch_entry")
+def fetch_entry(word):
+    if index is not None:
+        return index.get(word, {})
+    data = get_cache().get(word)
+    if data is None:
+        if offline:
+            return {}
+        metrics.increment("moedict.network_fetches")
+        data = get_fetcher().fetch(word)
+        get_cache().set(word, data)
+    return data
+
+
+@metrics.timed("moedict.fetch_entries")
+def fetch_entries(words):
+    # Looks up many words at once: duplicates are dropped, cached words are read from the cache and the rest
+    # is fetched concurrently. Returns {word: entry}.
+    words = list(dict.fromkeys(words))
+    if index is not None:
+        return {word: index.get(word, {}) for word in words}
+
+    entries = {}
+    missing = []
+    for word in words:
+        data = get_cache().get(word)
+        if data is None:
+            missing.append(word)
+        else:
+            entries[word] = data
+    if missing and offline:
+        entries.update((word, {}) for word in missing)
+    elif missing:
+        metrics.increment("moedict.network_fetches", len(missing))
+        for word, data in get_fetcher().fetch_many(missing).items():
+            get_cache().set(word, data)
+            entries[word] = data
+    return entries
+
+
+def get_all_pronunciations(input_string, entries=None):
     # Initialize a dictionary to store combinations and their possible pronunciations
     all_pronunciations = {}
-
-    # Loop over all possible substring lengths
-    for i in range(1, len(input_string) + 1):
-        # Generate all possible contiguous substrings of length i
-        for j in range(len(input_string) - i + 1):
-            combination = input_string[j:j+i]
-            # Look up the pronunciation of the combination
-            url = f"https://www.moedict.tw/uni/{combination}"
-            response = requests.get(url)
-            data = response.json()
-            # Handle variant characters
-            if 'heteronyms' in data.keys() and 'definitions' in data['heteronyms'][0].keys() and data['heteronyms'][0]['definitions'][0]['def'].endswith('的異體字。'):
-                variant = data['heteronyms'][0]['definitions'][0]['def'][1]
-                url = f"https://www.moedict.tw/uni/{variant}"
-                response = requests.get(url)
-                data = response.json()
-
-            pronunciations = get_pronunciations_for_word(data)
-            if pronunciations:
-                # Add the combination and its pronunciations to the dictionary
-                all_pronunciations[combination] = pronunciations
-
-                # If the combination has more than one character and has a unique pronunciation,
-                # add the pronunciation of the combination as a separate entry in the dictionary
-                if len(combination) > 1 and len(pronunciations) == 1 and len(pronunciations[0]) == 1:
-                    combination_pronunciation = [[pronunciations[0][0].replace(' ', '')]]
-                    all_pronunciations[combination] = combination_pronunciation
+    # Every entry looked up is also kept in entries, if given
+    if entries is None:
+        entries = {}
+
+    if index is not None:
+        # The offline index lists every dictionary word starting at position j in one walk
+        for j in range(len(input_string)):
+            for combination, data in index.words_starting_at(input_string, j):
+                entries[combination] = data
+                add_pronunciations(all_pronunciations, combination, data, entries)
+        return all_pronunciations
+
+    # All possible contiguous substrings, shortest first, fetched as one batch. Single characters with one
+    # reading come from the character index instead.
+    combinations = [input_string[j:j+i] for i in range(1, len(input_string) + 1)
+                    for j in range(len(input_string) - i + 1)]
+    resolved = {}
+    if char_index is not None:
+        for combination in combinations:
+            if len(combination) == 1 and combination not in entries:
+                readings = char_index.resolved_readings(combination)
+                if readings is not None:
+                    resolved[combination] = readings
+        metrics.increment("moedict.char_index_hits", len(resolved))
+    combinations_to_fetch = [combination for combination in combinations if combination not in resolved]
+    entries.update(fetch_entries([combination for combination in combinations_to_fetch
+                                  if combination not in entries]))
+    variants = [variant for variant in (get_variant(entries[combination]) for combination in combinations_to_fetch)
+                if variant and variant not in entries]
+    if variants:
+        # The second round trip, for the characters variants point to
+        metrics.increment("moedict.variant_fetches", len(variants))
+        with metrics.timer("moedict.variant_fetch"):
+            entries.update(fetch_entries(variants))
+
+    for combination in combinations:
+        # Look up the pronunciation of the combination
+        if combination in resolved:
+            if resolved[combination]:
+                all_pronunciations[combination] = resolved[combination]
+        else:
+            add_pronunciations(all_pronunciations, combination, entries[combination], entries)
 
     return all_pronunciations
 
 
+def get_variant(data):
+    # The character an entry defines itself as a variant of (「X」的異體字。), if any
+    if 'heteronyms' in data.keys() and 'definitions' in data['heteronyms'][0].keys() and data['heteronyms'][0]['definitions'][0]['def'].endswith('的異體字。'):
+        return data['heteronyms'][0]['definitions'][0]['def'][1]
+    return None
+
+
+def add_pronunciations(all_pronunciations, combination, data, entries=None):
+    # Handle variant characters
+    variant = get_variant(data)
+    if variant:
+        if entries is not None and variant in entries:
+            data = entries[variant]
+        else:
+            metrics.increment("moedict.variant_fetches")
+            with metrics.timer("moedict.variant_fetch"):
+                data = fetch_entry(variant)
+            if entries is not None:
+                entries[variant] = data
+
+    pronunciations = get_pronunciations_for_word(data)
+    if pronunciations:
+        # Add the combination and its pronunciations to the dictionary
+        all_pronunciations[combination] = pronunciations
+
+        # If the combination has more than one character and has a unique pronunciation,
+        # add the pronunciation of the combination as a separate entry in the dictionary
+        if len(combination) > 1 and len(pronunciations) == 1 and len(pronunciations[0]) == 1:
+            combination_pronunciation = [[pronunciations[0][0].replace(' ', '')]]
+            all_pronunciations[combination] = combination_pronunciation
+
+
 def get_pronunciations_for_word(data):
     bopomofo_variants = []
 
@@ -53,8 +224,9 @@ def get_pronunciations_for_word(data):
 
 
 # Define a function to tag a Chinese sentence using SpaCy
+@metrics.timed("spacy.tag_sentence")
 def tag_chinese_sentence(sentence):
-    doc = nlp(sentence)
+    doc = get_nlp()(sentence)
     tokens = list()
     pos = list()
     for token in doc:
@@ -63,6 +235,24 @@ def tag_chinese_sentence(sentence):
     return list(zip(tokens, pos))
 
 
+def tag_chinese_sentences(sentences, batch_size=256, n_process=1):
+    # Same output as tag_chinese_sentence for many sentences, through nlp.pipe; n_process > 1 tags the batches
+    # in worker processes
+    return list(iter_tag_chinese_sentences(sentences, batch_size, n_process))
+
+
+def iter_tag_chinese_sentences(sentences, batch_size=256, n_process=1):
+    # Lazy version for streams of sentences: the worker processes live as long as the generator. Each sentence's
+    # wait for nlp.pipe is timed (the first sentence of a batch waits for the whole batch).
+    docs = get_nlp().pipe(sentences, batch_size=batch_size, n_process=n_process)
+    while True:
+        with metrics.timer("spacy.tag_sentence"):
+            doc = next(docs, None)
+        if doc is None:
+            return
+        yield [(token.text, token.pos_) for token in doc]
+
+
 def get_moe_tag(spacy_tag):
     pos_to_dict = {
         "NOUN": ["名"],
@@ -93,15 +283,31 @@ def get_bopomofo_types(data):
     return bopomofo_types
 
 
-def find_pronunciation_for_sentence(sentence):
+def find_pronunciation_for_sentence(sentence, tagged=None, entries=None):
+    # tagged and entries let a SentenceAnalysis reuse its spaCy tags and collect the fetched entries
     pronunciations = list()
-    for token, pos in tag_chinese_sentence(sentence):
+    if tagged is None:
+        tagged = tag_chinese_sentence(sentence)
+    if entries is None:
+        entries = {}
+    # Single characters with at most one reading need no dictionary entry
+    known = {}
+    if char_index is not None:
+        for token, pos in tagged:
+            if pos != 'PUNCT' and len(token) == 1 and token not in entries:
+                readings = char_index.readings(token)
+                if readings is not None:
+                    known[token] = readings
+        metrics.increment("moedict.char_index_hits", len(known))
+    entries.update(fetch_entries([token for token, pos in tagged
+                                  if pos != 'PUNCT' and token not in entries and token not in known]))
+    for token, pos in tagged:
         if pos == 'PUNCT':
             pronunciations.append([token])
+        elif token in known:
+            pronunciations.append(list(known[token]))
         else:
-            url = f"https://www.moedict.tw/uni/{token}"
-            response = requests.get(url)
-            data = response.json()
+            data = entries[token]
             token_pron = get_pronunciations_for_word(data)
             if len(token_pron) > 1:
                 moe_tags = get_moe_tag(pos)
@@ -144,16 +350,44 @@ def get_valid_segmentations(sentence, pronunciation_dict):
     return valid_segmentations
 
 
-def best_guess_without_llm(sentence):
+def get_best_segmentations(s, pronunciation_dict, k=1):
+    # The k valid segmentations with the fewest tokens, in the order get_valid_segmentations lists them
+    # (among equally long ones, shorter leading tokens first). Dynamic programming from the end of the string:
+    # best[i] holds the k best lists of token lengths for s[i:], so this is O(len(s) * longest token * k).
+    max_length = max((len(token) for token in pronunciation_dict), default=0)
+    best = [[] for _ in range(len(s) + 1)]
+    best[len(s)] = [()]
+    for i in range(len(s) - 1, -1, -1):
+        candidates = []
+        for length in range(1, min(max_length, len(s) - i) + 1):
+            if s[i:i+length] in pronunciation_dict:
+                candidates.extend((length,) + rest for rest in best[i + length])
+        best[i] = sorted(candidates, key=lambda lengths: (len(lengths), lengths))[:k]
+
+    segmentations = []
+    for lengths in best[0]:
+        segmentation = []
+        start = 0
+        for length in lengths:
+            segmentation.append(s[start:start+length])
+            start += length
+        segmentations.append((segmentation, [pronunciation_dict[token] for token in segmentation]))
+    return segmentations
+
+
+def best_guess_without_llm(sentence, tagged=None, entries=None):
     return_word_pron = list()
 
-    word_tag_list = tag_chinese_sentence(sentence)
-    pron_list = find_pronunciation_for_sentence(sentence)
+    word_tag_list = tagged if tagged is not None else tag_chinese_sentence(sentence)
+    pron_list = find_pronunciation_for_sentence(sentence, word_tag_list, entries)
     word_pron_list = [(word_tag[0], pron) for word_tag, pron in zip(word_tag_list, pron_list)]
 
     for word, pron in word_pron_list:
         if len(pron) == 0:
-            segmented = sorted(get_valid_segmentations(word, get_all_pronunciations(word)), key=lambda x: len(x[1]))[0]
+            segmentations = get_best_segmentations(word, get_all_pronunciations(word, entries))
+            if not segmentations:
+                raise ValueError("No valid segmentation for: " + word)
+            segmented = segmentations[0]
             for word_part, word_part_pron in zip(segmented[0], segmented[1]):
                 return_word_pron.append((word_part, word_part_pron))
         else:
@@ -178,10 +412,9 @@ def replace_chinese_tag(tag):
     return tag_words.get(tag, tag)
 
 
-def get_def_examples(character):
-    url = f"https://www.moedict.tw/uni/{character}"
-    response = requests.get(url)
-    data = response.json()
+def get_def_examples(character, data=None):
+    if data is None:
+        data = fetch_entry(character)
 
     result = dict()
 
@@ -219,10 +452,9 @@ def get_def_examples(character):
     return result
 
 
-def get_def_examples_pinyin(character):
-    url = f"https://www.moedict.tw/uni/{character}"
-    response = requests.get(url)
-    data = response.json()
+def get_def_examples_pinyin(character, data=None):
+    if data is None:
+        data = fetch_entry(character)
 
     result = dict()
 
@@ -249,3 +481,40 @@ def get_def_examples_pinyin(character):
                     }
 
     return result
+
+
+class SentenceAnalysis:
+    # Runs spaCy once per sentence and fetches each dictionary entry once; the tokens, POS tags, pronunciations
+    # and definitions are then shared by moedict_api and prompt_generation
+    def __init__(self, sentence, tagged=None, entries=None):
+        # entries may hold dictionary entries already prefetched, e.g. for a whole batch of sentences
+        self.sentence = sentence
+        self.tagged = tagged if tagged is not None else tag_chinese_sentence(sentence)
+        self.entries = dict(entries) if entries else {}
+        self.best_guess = best_guess_without_llm(sentence, self.tagged, self.entries)
+
+    def tokens(self):
+        return [token for token, pos in self.tagged]
+
+    def pos_tags(self):
+        return [pos for token, pos in self.tagged]
+
+    def entry(self, word):
+        if word not in self.entries:
+            self.entries[word] = fetch_entry(word)
+        return self.entries[word]
+
+    def def_examples(self, word):
+        return get_def_examples(word, self.entry(word))
+
+    def best_guess_pos(self):
+        # The POS tag of the spaCy token each best-guess word comes from (segmenting splits tokens, never merges)
+        tags = []
+        i = 0
+        for token, pos in self.tagged:
+            covered = ''
+            while covered != token and i < len(self.best_guess):
+                covered += self.best_guess[i][0]
+                tags.append(pos)
+                i += 1
+        return tags
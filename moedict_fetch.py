@@ -0,0 +1,39 @@
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class MoedictFetcher:
+    # Fetches moedict entries over one keep-alive connection pool, several at a time, retrying rate limits
+    # and server errors with exponential backoff
+    def __init__(self, base_url="https://www.moedict.tw/uni/", max_workers=8, retries=3, backoff_factor=0.5,
+                 timeout=10):
+        self.base_url = base_url
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=["GET"])
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.requests_sent = 0
+
+    def fetch(self, word):
+        self.requests_sent += 1
+        response = self.session.get(self.base_url + quote(word), timeout=self.timeout)
+        return response.json()
+
+    def fetch_many(self, words):
+        # Returns {word: entry} for the distinct words, in their first-seen order
+        words = list(dict.fromkeys(words))
+        if len(words) <= 1 or self.max_workers <= 1:
+            return {word: self.fetch(word) for word in words}
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(words))) as executor:
+            return dict(zip(words, executor.map(self.fetch, words)))
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,136 @@
+import json
+import mmap
+import struct
+
+# Index file layout (little endian):
+#   magic (8 bytes), number of words n (uint32), padding (uint32)
+#   n + 1 key offsets (uint32), n + 1 record offsets (uint32)
+#   UTF-8 keys sorted bytewise (= by code point), concatenated
+#   one compact JSON record per key, in the same order, concatenated
+MAGIC = b"MOEIDX01"
+header = struct.Struct("<8sII")
+offset = struct.Struct("<I")
+
+
+def load_dump(dump_path):
+    # dump_path is a moedict JSON dump (e.g. dict-revised.json from g0v/moedict-data): a list of entries with a
+    # title and heteronyms, as returned by https://www.moedict.tw/uni/. Returns {title: entry}, the heteronyms of
+    # repeated titles merged.
+    with open(dump_path, encoding="utf-8") as f:
+        dump = json.load(f)
+
+    entries = {}
+    for entry in dump:
+        title = entry.get("title")
+        if not title:
+            continue
+        if title in entries:
+            entries[title]["heteronyms"] = entries[title].get("heteronyms", []) + entry.get("heteronyms", [])
+        else:
+            entries[title] = entry
+    return entries
+
+
+def build_index(dump_path, index_path):
+    entries = load_dump(dump_path)
+    keys = sorted(title.encode("utf-8") for title in entries)
+    records = [json.dumps(entries[key.decode("utf-8")], ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+               for key in keys]
+
+    key_offsets = [0]
+    for key in keys:
+        key_offsets.append(key_offsets[-1] + len(key))
+    record_offsets = [0]
+    for record in records:
+        record_offsets.append(record_offsets[-1] + len(record))
+    if record_offsets[-1] >= 2 ** 32:
+        raise ValueError("Dictionary dump too large for the index format")
+
+    with open(index_path, "wb") as f:
+        f.write(header.pack(MAGIC, len(keys), 0))
+        f.write(struct.pack(f"<{len(key_offsets)}I", *key_offsets))
+        f.write(struct.pack(f"<{len(record_offsets)}I", *record_offsets))
+        f.writelines(keys)
+        f.writelines(records)
+    return len(keys)
+
+
+class MoedictIndex:
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.size, _ = header.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a moedict index: " + path)
+        self.key_offsets_start = header.size
+        self.record_offsets_start = self.key_offsets_start + 4 * (self.size + 1)
+        self.keys_start = self.record_offsets_start + 4 * (self.size + 1)
+        self.records_start = self.keys_start + offset.unpack_from(self.map, self.record_offsets_start - 4)[0]
+
+    def __len__(self):
+        return self.size
+
+    def key(self, i):
+        start, end = struct.unpack_from("<II", self.map, self.key_offsets_start + 4 * i)
+        return self.map[self.keys_start + start:self.keys_start + end]
+
+    def record(self, i):
+        start, end = struct.unpack_from("<II", self.map, self.record_offsets_start + 4 * i)
+        return json.loads(self.map[self.records_start + start:self.records_start + end])
+
+    def bisect(self, target, lo, hi):
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find(self, word):
+        target = word.encode("utf-8")
+        i = self.bisect(target, 0, self.size)
+        if i < self.size and self.key(i) == target:
+            return i
+        return -1
+
+    def get(self, word, default=None):
+        i = self.find(word)
+        if i < 0:
+            return default
+        return self.record(i)
+
+    def __contains__(self, word):
+        return self.find(word) >= 0
+
+    def words_starting_at(self, text, start=0):
+        # Every dictionary word that text continues with at position start, shortest first, with its entry.
+        # The range of keys sharing the prefix only shrinks as the prefix grows, so this is a single walk down
+        # the sorted keys. No UTF-8 byte is 0xFF, so prefix + 0xFF sorts after every key with that prefix.
+        lo, hi = 0, self.size
+        for end in range(start + 1, len(text) + 1):
+            prefix = text[start:end].encode("utf-8")
+            lo = self.bisect(prefix, lo, hi)
+            hi = self.bisect(prefix + b"\xff", lo, hi)
+            if lo >= hi:
+                break
+            if self.key(lo) == prefix:
+                yield text[start:end], self.record(lo)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build an offline moedict index from a JSON dump.")
+    parser.add_argument("dump", help="moedict JSON dump, e.g. dict-revised.json")
+    parser.add_argument("index", help="index file to write, e.g. moedict.idx")
+    args = parser.parse_args(argv)
+    print(f"Indexed {build_index(args.dump, args.index)} words")
+
+
+if __name__ == '__main__':
+    main()
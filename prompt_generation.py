@@ -1,36 +1,128 @@
-from langchain.prompts import PromptTemplate
-from langchain.output_parsers import ResponseSchema, StructuredOutputParser
-from moedict_api import get_def_examples, best_guess_without_llm
+import os
+from functools import lru_cache
+import metrics
+from moedict_api import SentenceAnalysis, get_moe_tag, replace_chinese_tag
+from structured_output import PromptTemplate, StructuredOutput, format_instructions, parse_json_markdown, schema_line
+from token_count import count_tokens
 
 # os.environ['OPENAI_API_KEY'] = 'XYZ'
 
+# Part of the key of stored document conversions (see document_conversion.py): change it whenever the prompts
+# change, so sentences converted with the old prompts are converted again
+prompt_version = "1"
+
+# Compact prompts list each ambiguous word once, with the definitions matching its POS tag first, cut down
+# until the prompt fits the token budget; see configure_prompts
+compact_prompts = os.environ.get("COMPACT_PROMPTS") == "1"
+prompt_token_budget = int(os.environ["PROMPT_TOKEN_BUDGET"]) if os.environ.get("PROMPT_TOKEN_BUDGET") else None
+
+# (definitions per reading, examples per definition), tried in order until the prompt fits the budget
+compaction_levels = [(3, 2), (2, 1), (1, 1), (1, 0)]
+
+
+def configure_prompts(compact=False, token_budget=None):
+    global compact_prompts, prompt_token_budget
+    compact_prompts = compact
+    prompt_token_budget = token_budget
+
+
+# Templates and output formats are built once per process; a PromptGenerator only renders them for its sentence
+sentence_output = StructuredOutput([
+    ("zhuyin", "The sentence in Zhuyin only: replace every character by its Zhuyin, keeping the order of the "
+               "original sentence, e.g. 少了幾件 -> ㄕㄠˇ ˙ㄌㄜ ㄐㄧˇ ㄐㄧㄢˋ")
+])
+sentence_prompt = PromptTemplate('''I want to find the Zhuyin for the following sentence:\n{sentence}\nI have already tokenized the sentence and found the following pronunciations:\n{known_zhuyin}\n{dictionary}\nGiven this information, can you convert the sentence to Zhuyin, including the ambiguous ones? {format_instructions}''',
+                                 format_instructions=sentence_output.get_format_instructions())
+
+packed_template = '''I want to find the Zhuyin for each of the following sentences. I have already tokenized every sentence and found the pronunciations listed under it.\n\n{sentences}\nGiven this information, can you convert each sentence to Zhuyin, including the ambiguous ones? Replace every character by its Zhuyin, keeping the order of the original sentence, e.g. 少了幾件 -> ㄕㄠˇ ˙ㄌㄜ ㄐㄧˇ ㄐㄧㄢˋ. {format_instructions}'''
+span_template = '''In the sentence {sentence}, what is the Zhuyin of {span}? Its pronunciations are:\n{known_zhuyin}\n{dictionary}\n{format_instructions}'''
+# The span's description in the format instructions names the span too, so they are written into the template with
+# their braces escaped and {span} left as a variable
+span_output = StructuredOutput([("zhuyin", "The Zhuyin of {span} only, one syllable per character")])
+span_prompt = PromptTemplate(span_template.replace(
+    "{format_instructions}",
+    span_output.get_format_instructions().replace("{", "{{").replace("}", "}}").replace("{{span}}", "{span}")))
+
+
+def packed_schema(i):
+    return str(i), f"Sentence {i} in Zhuyin only"
+
+
+@lru_cache(maxsize=64)
+def packed_prompt(n_sentences):
+    # Output format and template for a packed prompt of n_sentences sentences
+    output = StructuredOutput([packed_schema(i) for i in range(1, n_sentences + 1)])
+    return output, PromptTemplate(packed_template, format_instructions=output.get_format_instructions())
+
+
+@lru_cache(maxsize=1)
+def packed_base_tokens():
+    # Tokens of a packed prompt without its sentences and their lines in the format instructions
+    return count_tokens(packed_template.format(sentences="", format_instructions=format_instructions([])))
+
+
+def packed_sentence_tokens(i, prompt_generator):
+    # Tokens that sentence number i adds to a packed prompt: its block and its line in the format instructions.
+    # Summed with packed_base_tokens this slightly overestimates the packed prompt, as the parts are counted apart.
+    return (count_tokens(sentence_block(i, prompt_generator) + "\n")
+            + count_tokens(schema_line(*packed_schema(i)) + "\n"))
+
+
+def sentence_block(i, prompt_generator):
+    prompt_generator.get_formatted_prompt()
+    block = f"Sentence {i}: {prompt_generator.sentence}\n{prompt_generator.known_zhuyin}\n"
+    if prompt_generator.dictionary:
+        block += f"{prompt_generator.dictionary}\n"
+    return block
+
 
 class PromptGenerator:
-    def __init__(self, sentence):
-        self.preprocessed = best_guess_without_llm(sentence)
-        self.response_schemas = [
-            ResponseSchema(name="zhuyin",
-                           description="The sentence in Zhuyin only: replace every character by its Zhuyin, keeping "
-                                       "the order of the original sentence, e.g. 少了幾件 -> ㄕㄠˇ ˙ㄌㄜ ㄐㄧˇ ㄐㄧㄢˋ")
-        ]
-
-        self.output_parser = StructuredOutputParser.from_response_schemas(self.response_schemas)
-        self.format_instructions = self.output_parser.get_format_instructions()
-        self.template = '''I want to find the Zhuyin for the following sentence:\n{sentence}\nI have already tokenized the sentence and found the following pronunciations:\n{known_zhuyin}\n{dictionary}\nGiven this information, can you convert the sentence to Zhuyin, including the ambiguous ones? {format_instructions}'''
-
-        self.multiple_input_prompt = PromptTemplate(
-            template=self.template,
-            input_variables=["sentence", "known_zhuyin", "dictionary"],
-            partial_variables={"format_instructions": self.format_instructions}
-        )
-
-        self.formatted_prompt = self.multiple_input_prompt.format_prompt(sentence=sentence,
-                                                                         known_zhuyin=self.generate_all_meaning_strings(),
-                                                                         dictionary=self.relevant_dictionary_entries())
+    # The dictionary work (SentenceAnalysis) happens here unless an analysis is passed in; the prompt text is
+    # rendered on first use
+    def __init__(self, sentence, analysis=None, compact=None, token_budget=None):
+        self.analysis = analysis if analysis is not None else SentenceAnalysis(sentence)
+        self.preprocessed = self.analysis.best_guess
+        self.compact = compact if compact is not None else compact_prompts
+        self.token_budget = token_budget if token_budget is not None else prompt_token_budget
+        self.output_parser = sentence_output
+        self.sentence = sentence
+        self.known_zhuyin = None
+        self.dictionary = None
+        self.formatted_prompt = None
+        self.over_budget = False
+
+    @metrics.timed("prompt.build")
+    def render(self):
+        self.known_zhuyin = self.generate_all_meaning_strings()
+        if not self.compact:
+            self.render_dictionary(self.relevant_dictionary_entries())
+        else:
+            for max_definitions, max_examples in compaction_levels:
+                self.render_dictionary(self.compact_dictionary_entries(max_definitions, max_examples))
+                if self.token_budget is None or self.prompt_token_count() <= self.token_budget:
+                    break
+            else:
+                # Still over the budget with one definition per reading: drop the definitions, keeping the
+                # readings, and record it if even that does not fit
+                self.render_dictionary('')
+                if self.prompt_token_count() > self.token_budget:
+                    self.over_budget = True
+                    metrics.increment("prompt.over_budget")
+        return self.formatted_prompt
+
+    def render_dictionary(self, dictionary):
+        self.dictionary = dictionary
+        self.formatted_prompt = sentence_prompt.format_prompt(sentence=self.sentence, known_zhuyin=self.known_zhuyin,
+                                                              dictionary=self.dictionary)
 
     def get_formatted_prompt(self):
+        if self.formatted_prompt is None:
+            self.render()
         return self.formatted_prompt
 
+    def prompt_token_count(self):
+        return count_tokens(self.get_formatted_prompt().to_string())
+
     def get_output_parser(self):
         return self.output_parser
 
@@ -51,7 +143,7 @@ class PromptGenerator:
             }
             return tag_words.get(tag, tag)
 
-        character_dict = get_def_examples(character)
+        character_dict = self.analysis.def_examples(character)
         meaning_string = f"The character {character} can have the following meanings:\n\n"
         list_number = 1
         for pinyin, meanings in character_dict.items():
@@ -86,3 +178,89 @@ class PromptGenerator:
         if len(entries) == 1:
             return ''
         return '\n'.join(entries)
+
+    def compact_meaning_string(self, character, pos, max_definitions, max_examples):
+        # Every reading keeps its definitions whose type fits the POS tag first, then the others, up to
+        # max_definitions
+        try:
+            preferred_types = [replace_chinese_tag(tag) for tag in get_moe_tag(pos)]
+        except KeyError:
+            preferred_types = []
+        character_dict = self.analysis.def_examples(character)
+        meaning_string = f"The character {character} can have the following meanings:\n\n"
+        list_number = 1
+        for pinyin, meanings in character_dict.items():
+            typed_meanings = [meaning for meaning in meanings.values() if 'def' in meaning and 'type' in meaning]
+            typed_meanings.sort(key=lambda meaning: meaning['type'] not in preferred_types)
+            for meaning in typed_meanings[:max_definitions]:
+                examples = ', '.join(meaning['examples'][:max_examples])
+                meaning_string += f"{list_number}. {meaning['type']} meaning \"{meaning['def']}\"."
+                if examples:
+                    meaning_string += f" For example: {examples}."
+                meaning_string += f" In this case, the Zhuyin is \"{pinyin.lower()}\".\n"
+                list_number += 1
+        return meaning_string
+
+    def compact_dictionary_entries(self, max_definitions, max_examples):
+        entries = ['The Zhuyin for the characters marked as unknown is ambiguous.']
+        seen = set()
+        for (word, pron_list), pos in zip(self.preprocessed, self.analysis.best_guess_pos()):
+            if len(pron_list) > 1 and word not in seen:
+                seen.add(word)
+                entries.append(self.compact_meaning_string(word, pos, max_definitions, max_examples))
+        if len(entries) == 1:
+            return ''
+        return '\n'.join(entries)
+
+
+class PackedPromptGenerator:
+    # Several sentences in one prompt, reusing each PromptGenerator's pronunciations and dictionary entries.
+    # The answer holds one Zhuyin string per sentence, keyed by the sentence's number.
+    @metrics.timed("prompt.build_packed")
+    def __init__(self, prompt_generators):
+        self.prompt_generators = prompt_generators
+        self.output_parser, template = packed_prompt(len(prompt_generators))
+        self.formatted_prompt = template.format_prompt(sentences=self.sentence_blocks())
+
+    def sentence_blocks(self):
+        return '\n'.join(sentence_block(i, prompt_generator)
+                          for i, prompt_generator in enumerate(self.prompt_generators, 1))
+
+    def get_formatted_prompt(self):
+        return self.formatted_prompt
+
+    def prompt_token_count(self):
+        return count_tokens(self.formatted_prompt.to_string())
+
+    def parse(self, response_string):
+        # The Zhuyin string for each sentence, or None for sentences missing from the answer
+        try:
+            answer = parse_json_markdown(response_string)
+        except ValueError:
+            return [None] * len(self.prompt_generators)
+        if not isinstance(answer, dict):
+            return [None] * len(self.prompt_generators)
+        zhuyins = []
+        for i in range(1, len(self.prompt_generators) + 1):
+            zhuyin = answer.get(str(i))
+            zhuyins.append(zhuyin if isinstance(zhuyin, str) else None)
+        return zhuyins
+
+
+class SpanPromptGenerator(PromptGenerator):
+    # A minimal prompt asking only for the words preprocessed[start:end] of an already prompted sentence, with
+    # the readings and dictionary entries of those words alone
+    @metrics.timed("prompt.build_span")
+    def __init__(self, prompt_generator, start, end):
+        self.analysis = prompt_generator.analysis
+        self.preprocessed = prompt_generator.preprocessed[start:end]
+        self.compact = prompt_generator.compact
+        self.token_budget = prompt_generator.token_budget
+        self.over_budget = False
+        self.output_parser = span_output
+        self.sentence = prompt_generator.sentence
+        self.span = ''.join(word for word, pron_list in self.preprocessed)
+        self.known_zhuyin = self.generate_all_meaning_strings()
+        self.dictionary = self.relevant_dictionary_entries()
+        self.formatted_prompt = span_prompt.format_prompt(sentence=self.sentence, span=self.span,
+                                                          known_zhuyin=self.known_zhuyin, dictionary=self.dictionary)
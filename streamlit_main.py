@@ -1,5 +1,57 @@
+import os
+import requests
 import streamlit as st
-from cc_main import *
+
+# With CONVERSION_SERVICE_URL set (e.g. http://127.0.0.1:8080, see conversion_service.py) the app only forwards
+# sentences to the service. Otherwise it converts in-process, with the model, tables and caches kept across reruns.
+service_url = os.environ.get("CONVERSION_SERVICE_URL")
+
+
+class ServiceError(Exception):
+    # The conversion failed for a reason other than the input: the service is busy (503) or the LLM or
+    # dictionary failed (5xx)
+    def __init__(self, message, busy=False):
+        super().__init__(message)
+        self.busy = busy
+
+
+@st.cache_resource
+def get_session():
+    return requests.Session()
+
+
+@st.cache_resource
+def get_local_service():
+    from conversion_service import ConversionService, warm_up
+
+    warm_up()
+    return ConversionService(workers=1, queue_size=0)
+
+
+@st.cache_data(max_entries=1000, show_spinner="Converting...")
+def convert(sentence):
+    # Only successful conversions are cached: a rejected sentence raises ValueError, any other failure ServiceError
+    if not service_url:
+        from cc_main import only_chinese
+
+        if not only_chinese(sentence):
+            raise ValueError("Not only traditional Chinese characters: " + sentence)
+        try:
+            return get_local_service().convert(sentence)
+        except Exception as e:
+            raise ServiceError(str(e))
+    response = get_session().post(service_url.rstrip("/") + "/convert", json={"sentence": sentence}, timeout=300)
+    try:
+        result = response.json()
+    except ValueError:
+        # An error page from a proxy in front of the service
+        result = {}
+    error = result.get("error", f"status {response.status_code}")
+    if response.status_code == 400:
+        raise ValueError(error)
+    if response.status_code != 200:
+        raise ServiceError(error, busy=response.status_code == 503)
+    return result
 
 
 def main():
@@ -8,19 +60,28 @@ def main():
     sentence = st.text_input("Enter your sentence: ")
     rerun_button = st.button("Rerun")
     if sentence and rerun_button:
-        if only_chinese(sentence):
-            try:
-                prompt, response = get_formatted_zhuyin_and_braille(sentence)
-                zhuyin = response['zhuyin']
-                braille = response['braille']
+        try:
+            response = convert(sentence)
+            zhuyin = response['zhuyin']
+            braille = response['braille']
+            if response['prompt']:
                 st.write("Prompt:")
-                st.write(f"```\n{prompt}\n```")
-                st.write("Zhuyin")
-                st.write(f"```\n{zhuyin}\n```")
-                st.write("Braille")
-                st.write(f"```\n{braille}\n```")
-            except ValueError:
-                st.write("Please enter only traditional Chinese characters ")
+                st.write(f"```\n{response['prompt']}\n```")
+            else:
+                st.write("Every character has a single reading, so GPT-4 was not asked.")
+            st.write("Zhuyin")
+            st.write(f"```\n{zhuyin}\n```")
+            st.write("Braille")
+            st.write(f"```\n{braille}\n```")
+        except ValueError:
+            st.write("Please enter only traditional Chinese characters ")
+        except ServiceError as e:
+            if e.busy:
+                st.write("The service is busy, please retry in a moment.")
+            else:
+                st.write(f"The conversion failed, please retry later: {e}")
+        except requests.RequestException:
+            st.write("The conversion service cannot be reached, please try again later.")
 
 
 if __name__ == '__main__':
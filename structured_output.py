@@ -0,0 +1,111 @@
+import json
+import re
+
+# Minimal stand-in for the parts of langchain the prompts used (PromptTemplate, ResponseSchema and
+# StructuredOutputParser). The format instructions are the same text, character for character, so prompts and
+# the LLM cache keys derived from them do not change.
+
+format_template = ('The output should be a markdown code snippet formatted in the following schema, including the '
+                   'leading and trailing "```json" and "```":\n\n```json\n{{\n{format}\n}}\n```')
+line_template = '\t"{name}": {type}  // {description}'
+# A fenced block up to its closing fence, else everything after an opening fence that is never closed
+json_markdown = re.compile(r"```(?:json)?(.*?)```", re.DOTALL)
+open_json_markdown = re.compile(r"```(?:json)?(.*)", re.DOTALL)
+strip_chars = " \n\r\t`"
+
+
+def format_instructions(schemas):
+    # schemas: (name, description) pairs, every value a string
+    return format_template.format(format="\n".join(schema_line(name, description) for name, description in schemas))
+
+
+def schema_line(name, description):
+    return line_template.format(name=name, type="string", description=description)
+
+
+def parse_partial_json(text):
+    # json.loads, but unclosed strings, objects and arrays are closed, and trailing text that is not JSON (prose
+    # after the object, a cut-off value) is dropped until the rest parses
+    try:
+        return json.loads(text, strict=False)
+    except json.JSONDecodeError:
+        pass
+    chars = []
+    closing = []
+    in_string = escaped = False
+    for char in text:
+        if in_string:
+            if char == '"' and not escaped:
+                in_string = False
+            elif char == "\n" and not escaped:
+                char = "\\n"
+            elif char == "\\":
+                escaped = not escaped
+            else:
+                escaped = False
+        elif char == '"':
+            in_string = True
+            escaped = False
+        elif char in "{[":
+            closing.append("}" if char == "{" else "]")
+        elif char in "}]":
+            if not closing or closing[-1] != char:
+                raise ValueError(f"Unbalanced {char} in {text!r}")
+            closing.pop()
+        chars.append(char)
+    if in_string:
+        chars.append('"')
+    closing.reverse()
+    while chars:
+        try:
+            return json.loads("".join(chars + closing), strict=False)
+        except json.JSONDecodeError:
+            chars.pop()
+    return json.loads(text, strict=False)
+
+
+def parse_json_markdown(text):
+    # The JSON object in an answer, bare or inside a ```json code block, with the same fallbacks as langchain's
+    # parser; raises ValueError (JSONDecodeError)
+    try:
+        return parse_partial_json(text.strip(strip_chars))
+    except ValueError:
+        match = json_markdown.search(text) or open_json_markdown.search(text)
+        return parse_partial_json((match.group(1) if match else text).strip(strip_chars))
+
+
+class StructuredOutput:
+    # Format instructions and parser for an answer holding one string per schema name
+    def __init__(self, schemas):
+        self.schemas = list(schemas)
+        self.format_instructions = format_instructions(self.schemas)
+
+    def get_format_instructions(self):
+        return self.format_instructions
+
+    def parse(self, text):
+        answer = parse_json_markdown(text)
+        if not isinstance(answer, dict):
+            raise ValueError(f"Got invalid return object. Expected a JSON object, but got {answer}")
+        for name, description in self.schemas:
+            if name not in answer:
+                raise ValueError(f"Got invalid return object. Expected key `{name}` to be present, but got {answer}")
+        return answer
+
+
+class FormattedPrompt:
+    def __init__(self, text):
+        self.text = text
+
+    def to_string(self):
+        return self.text
+
+
+class PromptTemplate:
+    # str.format template with some values filled in once (e.g. the format instructions)
+    def __init__(self, template, **partial_values):
+        self.template = template
+        self.partial_values = partial_values
+
+    def format_prompt(self, **values):
+        return FormattedPrompt(self.template.format(**self.partial_values, **values))
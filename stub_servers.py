@@ -0,0 +1,149 @@
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+
+# Local stand-ins for the remote services, for tests and benchmarks
+
+
+class StubServer(ThreadingHTTPServer):
+    # The default listen backlog of 5 drops connections under concurrent clients, which then wait for TCP
+    # retransmits
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class MoedictStubHandler(BaseHTTPRequestHandler):
+    # Serves /uni/<word> from server.entries; unknown words get an empty JSON object with status 404.
+    # The first server.failures requests are answered with 503 to exercise retries. Keep-alive, like moedict.tw
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        word = unquote(self.path.split("/uni/", 1)[-1])
+        with self.server.lock:
+            self.server.requests_served += 1
+            fail = self.server.requests_served <= self.server.failures
+        data = self.server.entries.get(word)
+        body = json.dumps(data if data is not None and not fail else {}, ensure_ascii=False).encode("utf-8")
+        self.send_response(503 if fail else 200 if data is not None else 404)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CompletionStubHandler(BaseHTTPRequestHandler):
+    # OpenAI-compatible POST .../chat/completions; server.responder turns the prompt into the answer text.
+    # The first server.failures requests are answered with 429 to exercise retries.
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        with self.server.lock:
+            self.server.requests_served += 1
+            fail = self.server.requests_served <= self.server.failures
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        if fail:
+            self.send_json(429, {"error": {"message": "Rate limit reached (stub)", "type": "requests"}})
+            return
+        prompt = request["messages"][-1]["content"]
+        self.send_json(200, {
+            "id": f"stub-{self.server.requests_served}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "stub"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": self.server.responder(prompt)},
+                         "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+        })
+
+    def send_json(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def dictionary_responder(prompt):
+    # Answers the prompts of prompt_generation without a model: every word gets its known reading, an unknown
+    # word the first reading its dictionary entries list. Packed prompts get one answer per sentence.
+    def answer(block):
+        first_readings = {}
+        for word, reading in re.findall(r'The character (\S+) can have the following meanings:\n\n1\. .*? '
+                                        r'In this case, the Zhuyin is "([^"]*)"', block):
+            first_readings.setdefault(word, reading)
+        readings = []
+        for word, reading in re.findall(r'^([^\s-]+)-([^\n]+)$', block, re.M):
+            readings.append(first_readings.get(word, '') if reading == 'unknown' else reading)
+        return ' '.join(' '.join(reading.split()) for reading in readings if reading)
+
+    sentences = re.split(r'^Sentence \d+: ', prompt, flags=re.M)[1:]
+    if sentences:
+        result = {str(i): answer(block) for i, block in enumerate(sentences, 1)}
+    else:
+        result = {"zhuyin": answer(prompt)}
+    return "```json\n" + json.dumps(result, ensure_ascii=False) + "\n```"
+
+
+def start_server(handler, port=0, **attributes):
+    # Runs the server on a daemon thread; returns it with its base URL
+    server = StubServer(("127.0.0.1", port), handler)
+    server.lock = threading.Lock()
+    server.requests_served = 0
+    for name, value in attributes.items():
+        setattr(server, name, value)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def start_moedict_stub(entries, port=0, failures=0):
+    # entries maps words to moedict entries as /uni/ returns them; the stub's URL goes into MOEDICT_URL
+    server, url = start_server(MoedictStubHandler, port, entries=entries, failures=failures)
+    return server, url + "/uni/"
+
+
+def start_completion_stub(responder=dictionary_responder, port=0, failures=0, delay=0.0):
+    # The returned URL goes into openai.api_base (or OPENAI_API_BASE)
+    server, url = start_server(CompletionStubHandler, port, responder=responder, failures=failures, delay=delay)
+    return server, url + "/v1"
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run a local stub of an external service.")
+    parser.add_argument("service", choices=["moedict", "completion"])
+    parser.add_argument("data", nargs="?",
+                        help="JSON file of recorded moedict entries ({word: entry}); moedict only")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds before each completion is answered")
+    args = parser.parse_args(argv)
+
+    if args.service == "moedict":
+        if args.data is None:
+            parser.error("the moedict stub needs a JSON file of entries")
+        with open(args.data, encoding="utf-8") as f:
+            server, url = start_moedict_stub(json.load(f), args.port)
+    else:
+        server, url = start_completion_stub(port=args.port, delay=args.delay)
+    print(f"Serving {args.service} stub at {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
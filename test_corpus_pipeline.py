@@ -0,0 +1,78 @@
+import csv
+
+import pytest
+
+import corpus_pipeline
+from corpus_pipeline import count_done, read_failed, run_pipeline
+
+
+class Answers(dict):
+    # Zhuyin (or an exception) per sentence, in place of spaCy, moedict and the LLM; asked lists the sentences
+    def __init__(self):
+        super().__init__()
+        self.asked = []
+
+    def get_zhuyins(self, sentences, tagged=None, fast_path=True, pack_tokens=None):
+        self.asked.extend(sentences)
+        return [self[sentence] if isinstance(self[sentence], Exception) else ('prompt', {'zhuyin': self[sentence]})
+                for sentence in sentences]
+
+
+@pytest.fixture
+def answers(monkeypatch):
+    answers = Answers()
+    monkeypatch.setattr(corpus_pipeline, "get_zhuyins", answers.get_zhuyins)
+    monkeypatch.setattr(corpus_pipeline, "iter_tag_chinese_sentences",
+                        lambda sentences, **kwargs: ([] for sentence in sentences))
+    return answers
+
+
+@pytest.fixture
+def paths(tmp_path):
+    return str(tmp_path / "in.txt"), str(tmp_path / "out.tsv")
+
+
+def write_input(path, sentences):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(sentences) + "\n")
+
+
+def read_output(path):
+    with open(path, encoding="utf-8", newline="") as f:
+        return list(csv.DictReader(f, delimiter='\t'))
+
+
+def test_newline_in_answer_keeps_one_line_per_row(answers, paths):
+    input_path, output_path = paths
+    answers.update({'長長': 'ㄔㄤˊ\nㄔㄤˊ', '慢': 'ㄇㄢˋ'})
+    write_input(input_path, ['長長', '慢'])
+    assert run_pipeline(input_path, output_path) == (2, 0)
+    assert count_done(output_path) == 2
+    assert [row['target_zhuyin'] for row in read_output(output_path)] == ['ㄔㄤˊ ㄔㄤˊ', 'ㄇㄢˋ']
+
+
+def test_failed_rows_are_retried_on_resume(answers, paths):
+    input_path, output_path = paths
+    answers.update({'長長': RuntimeError('outage'), '慢': 'ㄇㄢˋ', '延': 'ㄧㄢˊ…'})
+    write_input(input_path, ['長長', '慢', '延'])
+    assert run_pipeline(input_path, output_path) == (3, 2)
+    assert read_failed(output_path) == {0, 2}
+
+    answers.update({'長長': 'ㄔㄤˊ ㄔㄤˊ', '延': 'ㄧㄢˊ'})
+    answers.asked.clear()
+    assert run_pipeline(input_path, output_path) == (3, 0)
+    assert answers.asked == ['長長', '延']
+    assert read_failed(output_path) == set()
+    assert [row['target_braille'] != '' for row in read_output(output_path)] == [True, True, True]
+
+
+def test_target_past_the_answer_is_not_retried(answers, tmp_path):
+    input_path, output_path = str(tmp_path / "in.tsv"), str(tmp_path / "out.tsv")
+    with open(input_path, "w", encoding="utf-8") as f:
+        f.write("sentence\ttarget\ttarget_pos\n長長大\t大\t2\n")
+    answers['長長大'] = 'ㄔㄤˊ ㄔㄤˊ'
+    assert run_pipeline(input_path, output_path) == (1, 0)
+    assert read_output(output_path)[0]['target_zhuyin'] == ''
+    answers.asked.clear()
+    assert run_pipeline(input_path, output_path) == (1, 0)
+    assert answers.asked == []
@@ -0,0 +1,46 @@
+from disk_cache import DiskCache
+
+
+def test_hits_do_not_write(tmp_path):
+    cache = DiskCache(str(tmp_path / "cache.sqlite"))
+    cache.set("a", {"value": 1})
+    changes = cache.connection.total_changes
+    for i in range(10):
+        assert cache.get("a") == {"value": 1}
+    assert cache.get_many(["a", "b"]) == {"a": {"value": 1}}
+    assert cache.connection.total_changes == changes
+    cache.close()
+
+
+def test_access_times_are_written_in_batches(tmp_path):
+    cache = DiskCache(str(tmp_path / "cache.sqlite"))
+    cache.access_batch = 2
+    cache.set_many([("a", 1), ("b", 2)])
+    accessed = dict(cache.connection.execute("SELECT key, accessed FROM cache"))
+    cache.get("a")
+    cache.get("b")
+    assert all(time > accessed[key] for key, time in cache.connection.execute("SELECT key, accessed FROM cache"))
+    cache.close()
+
+
+def test_eviction_keeps_recently_read_entries(tmp_path):
+    cache = DiskCache(str(tmp_path / "cache.sqlite"), max_entries=3)
+    for key in "abc":
+        cache.set(key, key)
+    cache.get("a")
+    cache.set("d", "d")
+    assert "a" in cache and "b" not in cache
+    assert len(cache) == 3
+    cache.close()
+
+
+def test_eviction_counts_entries_written_by_others(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    first = DiskCache(path, max_entries=3)
+    second = DiskCache(path, max_entries=3)
+    first.set_many([("a", 1), ("b", 2)])
+    second.set_many([("c", 3), ("d", 4)])
+    assert len(first) == 3 and first.stats()["entries"] == 3
+    assert "a" not in second
+    first.close()
+    second.close()
@@ -0,0 +1,21 @@
+import prompt_generation
+from document_conversion import sentence_key, split_sentences
+
+
+def test_split_sentences():
+    assert split_sentences('他說：「好。」我走了！\n下一行') == ['他說：「好。」', '我走了！', '下一行']
+
+
+def test_ellipsis_stays_whole():
+    assert split_sentences('好。……好') == ['好。……', '好']
+    assert split_sentences('好……。」好') == ['好……。」', '好']
+
+
+def test_prompt_settings_change_the_key(monkeypatch):
+    key = sentence_key('我喜歡長頸鹿')
+    assert sentence_key('我喜歡長頸鹿', pack_tokens=3000) != key
+    monkeypatch.setattr(prompt_generation, "compact_prompts", True)
+    compact_key = sentence_key('我喜歡長頸鹿')
+    assert compact_key != key
+    monkeypatch.setattr(prompt_generation, "prompt_token_budget", 500)
+    assert sentence_key('我喜歡長頸鹿') != compact_key
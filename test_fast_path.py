@@ -0,0 +1,18 @@
+from cc_main import is_unambiguous, zhuyin_from_pronunciations
+
+
+def test_single_readings_skip_the_llm():
+    preprocessed = [('我', ['ㄨㄛˇ']), ('走路', ['ㄗㄡˇ　ㄌㄨˋ', 'ㄗㄡˇ　ㄌㄨˋ']), ('。', ['。'])]
+    assert is_unambiguous(preprocessed)
+    assert zhuyin_from_pronunciations(preprocessed) == 'ㄨㄛˇ ㄗㄡˇ ㄌㄨˋ 。'
+
+
+def test_polyphones_go_to_the_llm():
+    assert not is_unambiguous([('我', ['ㄨㄛˇ']), ('長', ['ㄔㄤˊ', 'ㄓㄤˇ'])])
+
+
+def test_labelled_readings_go_to_the_llm():
+    # A polyphone whose POS filter leaves one reading, still carrying moedict's label
+    assert not is_unambiguous([('行', ['（讀音）ㄒㄧㄥˋ'])])
+    assert not is_unambiguous([('行', ['（語音）ㄏㄤˊ'])])
+    assert not is_unambiguous([('行', [])])
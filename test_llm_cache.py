@@ -0,0 +1,64 @@
+import pytest
+
+import cc_main
+from structured_output import FormattedPrompt, StructuredOutput
+
+bad_answer = 'I am not sure.'
+good_answer = '```json\n{"zhuyin": "ㄔㄤˊ"}\n```'
+
+
+class FakePromptGenerator:
+    output_parser = StructuredOutput([("zhuyin", "The sentence in Zhuyin only")])
+
+    def __init__(self, prompt):
+        self.prompt = FormattedPrompt(prompt)
+
+    def get_formatted_prompt(self):
+        return self.prompt
+
+    def get_output_parser(self):
+        return self.output_parser
+
+
+class FakeDispatcher:
+    def __init__(self, answers):
+        self.answers = answers
+        self.prompts = []
+
+    def run(self, prompts, return_exceptions=False):
+        self.prompts.extend(prompts)
+        return [self.answers.pop(0) for prompt in prompts]
+
+
+@pytest.fixture
+def llm_cache(tmp_path):
+    yield cc_main.configure_llm_cache(str(tmp_path / "llm_cache.sqlite"))
+    cc_main.llm_cache.close()
+    cc_main.llm_cache = None
+
+
+def test_unparsable_answer_is_asked_again(llm_cache, monkeypatch):
+    answers = [bad_answer, good_answer]
+    requested = []
+
+    def request_completion(prompt):
+        requested.append(prompt)
+        return answers.pop(0)
+
+    monkeypatch.setattr(cc_main, "request_completion", request_completion)
+    prompt_generator = FakePromptGenerator("prompt")
+    with pytest.raises(ValueError):
+        cc_main.get_parsed_answer(prompt_generator)
+    assert cc_main.get_parsed_answer(prompt_generator) == {'zhuyin': 'ㄔㄤˊ'}
+    assert cc_main.get_parsed_answer(prompt_generator) == {'zhuyin': 'ㄔㄤˊ'}
+    assert len(requested) == 2
+
+
+def test_unparsable_batch_answer_is_asked_again(llm_cache, monkeypatch):
+    dispatcher = FakeDispatcher([bad_answer, good_answer])
+    monkeypatch.setattr(cc_main, "get_dispatcher", lambda: dispatcher)
+    prompt_generators = [FakePromptGenerator("prompt")]
+    assert cc_main.get_parsed_answers(prompt_generators) == [None]
+    assert cc_main.get_parsed_answers(prompt_generators) == [{'zhuyin': 'ㄔㄤˊ'}]
+    assert cc_main.get_parsed_answers(prompt_generators) == [{'zhuyin': 'ㄔㄤˊ'}]
+    assert len(dispatcher.prompts) == 2
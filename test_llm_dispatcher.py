@@ -0,0 +1,57 @@
+import re
+import time
+
+import openai
+import pytest
+
+from llm_dispatcher import CompletionDispatcher
+from stub_servers import start_completion_stub
+
+
+def reversed_responder(prompt):
+    # Earlier prompts are answered later, so the responses arrive out of order
+    index = int(re.search(r'\d+', prompt).group())
+    time.sleep(0.02 * (8 - index))
+    return f"answer {index}"
+
+
+@pytest.fixture
+def completion_stub(monkeypatch):
+    servers = []
+
+    def start(responder, failures=0):
+        server, url = start_completion_stub(responder, failures=failures)
+        servers.append(server)
+        monkeypatch.setattr(openai, "api_base", url)
+        monkeypatch.setattr(openai, "api_key", "stub")
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+
+
+def test_run_keeps_input_order(completion_stub):
+    server = completion_stub(reversed_responder)
+    dispatcher = CompletionDispatcher(max_in_flight=8)
+    prompts = [f"prompt {i}" for i in range(8)]
+    assert dispatcher.run(prompts) == [f"answer {i}" for i in range(8)]
+    assert dispatcher.requests_sent == 8 and dispatcher.retries == 0
+    assert server.requests_served == 8
+
+
+def test_run_retries_rate_limits(completion_stub):
+    server = completion_stub(reversed_responder, failures=3)
+    dispatcher = CompletionDispatcher(max_in_flight=4, backoff=0.01)
+    prompts = [f"prompt {i}" for i in range(6)]
+    assert dispatcher.run(prompts) == [f"answer {i}" for i in range(6)]
+    assert dispatcher.retries == 3
+    assert server.requests_served == 9
+
+
+def test_run_returns_exceptions_after_the_last_retry(completion_stub):
+    completion_stub(reversed_responder, failures=100)
+    dispatcher = CompletionDispatcher(max_in_flight=2, max_retries=1, backoff=0.01)
+    results = dispatcher.run(["prompt 1", "prompt 2"], return_exceptions=True)
+    assert all(isinstance(result, openai.error.RateLimitError) for result in results)
+    assert dispatcher.retries == 2
@@ -0,0 +1,48 @@
+import pytest
+import requests
+
+from moedict_fetch import MoedictFetcher
+from stub_servers import start_moedict_stub
+
+entries = {
+    '長': {'title': '長', 'heteronyms': [{'bopomofo': 'ㄔㄤˊ'}, {'bopomofo': 'ㄓㄤˇ'}]},
+    '慢': {'title': '慢', 'heteronyms': [{'bopomofo': 'ㄇㄢˋ'}]},
+}
+
+
+def test_fetch_many_deduplicates():
+    server, url = start_moedict_stub(entries)
+    try:
+        fetcher = MoedictFetcher(url, max_workers=4)
+        result = fetcher.fetch_many(['長', '慢', '長', '沒有', '慢'])
+        assert list(result) == ['長', '慢', '沒有']
+        assert result['長'] == entries['長'] and result['慢'] == entries['慢']
+        assert result['沒有'] == {}
+        assert fetcher.requests_sent == 3
+        assert server.requests_served == 3
+        fetcher.close()
+    finally:
+        server.shutdown()
+
+
+def test_fetch_many_retries_server_errors():
+    server, url = start_moedict_stub(entries, failures=2)
+    try:
+        fetcher = MoedictFetcher(url, max_workers=1, retries=3, backoff_factor=0)
+        assert fetcher.fetch_many(['長', '慢']) == entries
+        assert server.requests_served == 4
+        fetcher.close()
+    finally:
+        server.shutdown()
+
+
+def test_fetch_gives_up_after_retries():
+    server, url = start_moedict_stub(entries, failures=10)
+    try:
+        fetcher = MoedictFetcher(url, max_workers=1, retries=2, backoff_factor=0)
+        with pytest.raises(requests.exceptions.RetryError):
+            fetcher.fetch('長')
+        assert server.requests_served == 3
+        fetcher.close()
+    finally:
+        server.shutdown()
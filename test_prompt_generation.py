@@ -0,0 +1,31 @@
+from prompt_generation import PromptGenerator
+
+
+class Analysis:
+    # A SentenceAnalysis for 長 with several long definitions per reading
+    best_guess = [('長', ['ㄔㄤˊ', 'ㄓㄤˇ'])]
+
+    def best_guess_pos(self):
+        return ['ADJ']
+
+    def def_examples(self, character):
+        meaning = {'def': '距離大的' * 20, 'type': '形', 'examples': ['長頸鹿', '長江']}
+        return {'ㄔㄤˊ': {i: meaning for i in range(3)}, 'ㄓㄤˇ': {i: meaning for i in range(3)}}
+
+
+def test_definitions_are_dropped_to_fit_the_budget():
+    bare = PromptGenerator('長', analysis=Analysis(), compact=True)
+    bare.known_zhuyin = bare.generate_all_meaning_strings()
+    bare.render_dictionary('')
+    without_definitions = bare.prompt_token_count()
+    prompt_generator = PromptGenerator('長', analysis=Analysis(), compact=True, token_budget=without_definitions)
+    assert prompt_generator.prompt_token_count() <= without_definitions
+    assert prompt_generator.dictionary == ''
+    assert not prompt_generator.over_budget
+
+
+def test_over_budget_prompts_are_flagged():
+    prompt_generator = PromptGenerator('長', analysis=Analysis(), compact=True, token_budget=10)
+    assert prompt_generator.get_formatted_prompt() is not None
+    assert prompt_generator.dictionary == ''
+    assert prompt_generator.over_budget
@@ -0,0 +1,49 @@
+import pytest
+
+from structured_output import StructuredOutput
+
+output_parsers = pytest.importorskip("langchain.output_parsers")
+
+schemas = [("zhuyin", "The sentence in Zhuyin only")]
+
+# Answer shapes seen from chat models, parsed the way langchain's StructuredOutputParser parses them
+responses = [
+    '```json\n{"zhuyin": "ㄅㄚ"}\n```',
+    'Here:\n```json\n{"zhuyin": "ㄅㄚ"}\n```\nDone',
+    'Here is the Zhuyin:\n```\n{"zhuyin": "ㄅㄚ"}\n```\nThe end.',
+    '{"zhuyin": "ㄅㄚ"}',
+    '```json\n{"zhuyin": "ㄅㄚ"}',
+    '```json\n{"zhuyin": "ㄅㄚ"\n```',
+    '```json\n{"zhuyin": "ㄅㄚ",}\n```',
+    '```json\n{"zhuyin": "multi\nline"}\n```',
+    '```json\n{"zhuyin": "ㄅㄚ"}\n```\n```json\n{"zhuyin": "ㄆㄚ"}\n```',
+    'Sure! {"zhuyin": "ㄅㄚ"}',
+    '```json\n{"other": "x"}\n```',
+    '```json\n["ㄅㄚ"]\n```',
+    'no JSON at all',
+    '',
+]
+
+
+def langchain_parser(schemas):
+    return output_parsers.StructuredOutputParser.from_response_schemas(
+        [output_parsers.ResponseSchema(name=name, description=description) for name, description in schemas])
+
+
+def parse_or_error(parser, text):
+    try:
+        return parser.parse(text)
+    except ValueError:
+        return ValueError
+
+
+def test_format_instructions_match_langchain():
+    packed = [(str(i), f"Sentence {i} in Zhuyin only") for i in range(1, 4)]
+    for schema_list in (schemas, packed):
+        assert (StructuredOutput(schema_list).get_format_instructions()
+                == langchain_parser(schema_list).get_format_instructions())
+
+
+@pytest.mark.parametrize("response", responses)
+def test_parse_matches_langchain(response):
+    assert parse_or_error(StructuredOutput(schemas), response) == parse_or_error(langchain_parser(schemas), response)
@@ -0,0 +1,50 @@
+from braille_converter import tokenize_zhuyin
+from zhuyin_alignment import misaligned_span, span_layout, splice_zhuyin
+
+wo = ('我', ['ㄨㄛˇ'])
+zhang = ('長', ['ㄔㄤˊ', 'ㄓㄤˇ'])
+da = ('大', ['ㄉㄚˋ'])
+
+
+def repair(preprocessed, answer, span_answer):
+    start, end, first, last = misaligned_span(preprocessed, answer)
+    return splice_zhuyin(answer, first, last, span_answer, span_layout(preprocessed, start, end))
+
+
+def test_aligned_answer():
+    assert misaligned_span([wo, zhang, da, ('。', ['。'])], 'ㄨㄛˇ ㄓㄤˇ ㄉㄚˋ 。') is None
+
+
+def test_leftover_character_is_replaced():
+    preprocessed = [wo, zhang, da]
+    assert misaligned_span(preprocessed, 'ㄨㄛˇ 長 ㄉㄚˋ')[:2] == (1, 2)
+    assert misaligned_span(preprocessed, 'ㄨㄛˇ 長 ㄓㄤˇ ㄉㄚˋ') is not None
+    repaired = repair(preprocessed, 'ㄨㄛˇ 長 ㄉㄚˋ', 'ㄓㄤˇ')
+    assert repaired == 'ㄨㄛˇ ㄓㄤˇ ㄉㄚˋ'
+    assert misaligned_span(preprocessed, repaired) is None
+
+
+def test_span_across_punctuation_keeps_it():
+    preprocessed = [wo, zhang, ('，', ['，']), ('行', ['ㄒㄧㄥˊ', 'ㄏㄤˊ']), ('了', ['˙ㄌㄜ', 'ㄌㄧㄠˇ'])]
+    answer = 'ㄨㄛˇ ㄓㄤˋ，ㄒㄧㄥˋ ˙ㄌㄜ'
+    assert misaligned_span(preprocessed, answer)[:2] == (1, 4)
+    for span_answer in ('ㄓㄤˇ ， ㄒㄧㄥˊ', 'ㄓㄤˇ ㄒㄧㄥˊ'):
+        repaired = repair(preprocessed, answer, span_answer)
+        assert repaired == 'ㄨㄛˇ ㄓㄤˇ ， ㄒㄧㄥˊ ˙ㄌㄜ'
+        assert misaligned_span(preprocessed, repaired) is None
+
+
+def test_syllable_dropped_at_the_end_goes_before_the_period():
+    preprocessed = [wo, zhang, da, ('。', ['。'])]
+    answer = 'ㄨㄛˇ ㄓㄤˇ 。'
+    assert misaligned_span(preprocessed, answer)[:2] == (2, 3)
+    repaired = repair(preprocessed, answer, 'ㄉㄚˋ')
+    assert repaired == 'ㄨㄛˇ ㄓㄤˇ ㄉㄚˋ 。'
+    assert tokenize_zhuyin(repaired)[-1] == '。'
+    assert misaligned_span(preprocessed, repaired) is None
+
+
+def test_syllable_dropped_before_punctuation():
+    preprocessed = [wo, zhang, ('，', ['，']), da]
+    repaired = repair(preprocessed, 'ㄨㄛˇ ， ㄉㄚˋ', 'ㄓㄤˇ')
+    assert repaired == 'ㄨㄛˇ ㄓㄤˇ ， ㄉㄚˋ'
@@ -0,0 +1,23 @@
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model):
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text, model="gpt-4"):
+    # Exact with tiktoken installed; otherwise an estimate of one token per non-ASCII (e.g. Chinese or Zhuyin)
+    # character and one per four ASCII characters
+    encoding = get_encoding(model)
+    if encoding is not None:
+        return len(encoding.encode(text))
+    ascii_chars = sum(1 for char in text if char < '\x80')
+    return len(text) - ascii_chars + (ascii_chars + 3) // 4
@@ -0,0 +1,114 @@
+from braille_converter import normalize_syllable, punct, tokenize_zhuyin, zhuyin, zhuyin_syllables
+from moedict_api import get_pronunciations_for_word
+
+
+# Checks an answer's Zhuyin against the words from best_guess_without_llm: every Chinese word has to be spelled
+# with one of its dictionary readings, in order. Where that fails, misaligned_span finds the smallest run of
+# words that has to be asked again.
+punctuation_chars = set(''.join(punct))
+
+
+def is_chinese(char):
+    return '\u4e00' <= char <= '\u9fff'
+
+
+def is_punctuation(token):
+    return all(char in punctuation_chars for char in token)
+
+
+def word_readings(word, pron_list, entry=None):
+    # Every reading of a word as a tuple of normalized syllables: the ones best_guess_without_llm kept, plus
+    # the others in its dictionary entry (the POS filter can drop the reading the sentence needs)
+    readings = list(pron_list)
+    if entry:
+        readings.extend(get_pronunciations_for_word(entry))
+    return {tuple(normalize_syllable(syllable) for syllable in reading.split()) for reading in readings}
+
+
+def match_reading(syllables, begin, end, readings, from_end=False):
+    # Length of the longest reading found at syllables[begin:] (or ending at syllables[:end] with from_end)
+    # without leaving syllables[begin:end]; None if no reading fits
+    for reading in sorted(readings, key=len, reverse=True):
+        if len(reading) > end - begin:
+            continue
+        start = end - len(reading) if from_end else begin
+        if tuple(syllables[start:start + len(reading)]) == reading:
+            return len(reading)
+    return None
+
+
+def misaligned_span(preprocessed, zhuyin_string, entries=None):
+    # None if the answer is aligned. Otherwise (start, end, first, last): the words preprocessed[start:end]
+    # could not be matched, and the tokens tokenize_zhuyin(zhuyin_string)[first:last] hold whatever the answer
+    # has in their place. Words are matched from both ends, so the span is only as wide as the damage.
+    # Tokens that are neither Zhuyin nor punctuation (a character left untranscribed) match no reading.
+    entries = entries if entries is not None else {}
+    tokens = tokenize_zhuyin(zhuyin_string)
+    positions = [i for i, token in enumerate(tokens) if not is_punctuation(token)]
+    syllables = [normalize_syllable(tokens[i]) if tokens[i][0] in zhuyin else tokens[i] for i in positions]
+    words = [i for i, (word, pron_list) in enumerate(preprocessed) if any(is_chinese(char) for char in word)]
+    readings = [word_readings(preprocessed[i][0], preprocessed[i][1], entries.get(preprocessed[i][0]))
+                for i in words]
+
+    # starts[k]: first syllable of words[k], for the words matched from the left
+    starts = [0]
+    while len(starts) <= len(words):
+        length = match_reading(syllables, starts[-1], len(syllables), readings[len(starts) - 1])
+        if length is None:
+            break
+        starts.append(starts[-1] + length)
+    left = len(starts) - 1
+    if left == len(words):
+        if starts[-1] == len(syllables):
+            return None
+        # Extra syllables after the last word: ask for the last word again
+        left = max(left - 1, 0)
+
+    # From the right, leaving at least one word to ask about
+    end = len(syllables)
+    right = len(words)
+    while right > left + 1:
+        length = match_reading(syllables, starts[left], end, readings[right - 1], from_end=True)
+        if length is None:
+            break
+        end -= length
+        right -= 1
+
+    # The tokens between the last syllable matched from the left and the first one matched from the right,
+    # punctuation included
+    begin = starts[left]
+    first = positions[begin - 1] + 1 if begin > 0 else 0
+    last = positions[end] if end < len(positions) else len(tokens)
+    if not words:
+        return 0, 0, first, last
+    return words[left], words[right - 1] + 1, first, last
+
+
+def span_layout(preprocessed, start, end):
+    # The words preprocessed[start:end] with the punctuation around them, up to the neighbouring Chinese words:
+    # what the tokens [first:last] of misaligned_span stand for
+    while start > 0 and not any(is_chinese(char) for char in preprocessed[start - 1][0]):
+        start -= 1
+    while end < len(preprocessed) and not any(is_chinese(char) for char in preprocessed[end][0]):
+        end += 1
+    return preprocessed[start:end]
+
+
+def splice_zhuyin(zhuyin_string, first, last, replacement, layout):
+    # The answer with tokens [first:last] replaced, space separated: the syllables of replacement, one per
+    # character of the Chinese words in layout (see span_layout), and the sentence's punctuation between them
+    tokens = tokenize_zhuyin(zhuyin_string)
+    syllables = zhuyin_syllables(replacement)
+    spliced = []
+    insert_at = 0
+    for word, pron_list in layout:
+        n_chars = sum(is_chinese(char) for char in word)
+        if n_chars:
+            spliced.extend(syllables[:n_chars])
+            syllables = syllables[n_chars:]
+            insert_at = len(spliced)
+        else:
+            spliced.extend(tokenize_zhuyin(word))
+    # Syllables beyond the characters stay after the last word, so the check of the result rejects them
+    spliced[insert_at:insert_at] = syllables
+    return ' '.join(tokens[:first] + spliced + tokens[last:])